@@ -0,0 +1,645 @@
+import argparse
+import gc
+import json
+import os
+import random
+import secrets
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Бенчмарки сервера Vox. Каждый сценарий работает на временной базе,
+# сервер импортируется после того как VOX_DB_FILE указывает на неё.
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+def summarize(name, latencies, elapsed):
+    return {
+        'name': name,
+        'count': len(latencies),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3) if latencies else 0.0
+    }
+
+def print_results(results):
+    print(f"{'сценарий':<32}{'кол-во':>10}{'оп/с':>12}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}")
+    for r in results:
+        print(f"{r['name']:<32}{r['count']:>10}{r['throughput']:>12}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+def write_json(path, scenario, params, results, **extra):
+    if not path:
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        params = {k: v for k, v in params.items() if k != 'func'}
+        json.dump(dict({'scenario': scenario, 'params': params, 'results': results,
+                        'timestamp': time.time()}, **extra), f, ensure_ascii=False, indent=2)
+
+def use_temp_database(directory=None):
+    tmp = tempfile.mkdtemp(prefix='vox_bench_', dir=directory)
+    os.environ['VOX_DB_FILE'] = os.path.join(tmp, 'bench.db')
+    return tmp
+
+def seed_database(conn, users, chats, memberships, messages):
+    rnd = random.Random(42)
+    c = conn.cursor()
+    c.executemany("INSERT INTO users (id, username, password_hash) VALUES (?, ?, ?)",
+                  ((i, f'user{i}', 'x') for i in range(1, users + 1)))
+    tokens = [secrets.token_hex(32) for _ in range(users)]
+    expires_at = int(time.time()) + 24 * 3600
+    c.executemany("INSERT INTO sessions (user_id, token, expires_at) VALUES (?, ?, ?)",
+                  ((i + 1, t, expires_at) for i, t in enumerate(tokens)))
+    c.executemany("INSERT INTO chats (id, name, type) VALUES (?, ?, ?)",
+                  ((i, f'chat{i}', 'group') for i in range(1, chats + 1)))
+    pairs = set()
+    while len(pairs) < memberships:
+        pairs.add((rnd.randint(1, chats), rnd.randint(1, users)))
+    c.executemany("INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)", sorted(pairs))
+    c.executemany("INSERT INTO messages (chat_id, user_id, content) VALUES (?, ?, ?)",
+                  ((rnd.randint(1, chats), rnd.randint(1, users), f'message {i}') for i in range(messages)))
+    # Денормализованные поля, которые на проде поддерживает писатель сообщений
+    c.execute("UPDATE chats SET last_message_id = (SELECT MAX(id) FROM messages WHERE chat_id = chats.id)")
+    c.execute("UPDATE chat_members SET last_read_message_id = (SELECT last_message_id FROM chats WHERE id = chat_members.chat_id) - ?",
+              (messages // 100,))
+    conn.commit()
+    return tokens
+
+def measure_chats(client, tokens, requests_count):
+    rnd = random.Random(7)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(requests_count):
+        token = rnd.choice(tokens)
+        t0 = time.perf_counter()
+        response = client.get('/api/chats', query_string={'token': token})
+        latencies.append(time.perf_counter() - t0)
+        assert response.status_code == 200, response.status_code
+    return latencies, time.perf_counter() - started
+
+def bench_chats(args):
+    tmp = use_temp_database()
+    try:
+        import server
+        with server.get_db() as conn:
+            server.apply_migrations(conn)
+            print(f"Заполнение: {args.messages} сообщений, {args.memberships} участий...")
+            tokens = seed_database(conn, args.users, args.chats, args.memberships, args.messages)
+            # "до": та же схема без вторичных индексов
+            indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'").fetchall()
+            for name, _ in indexes:
+                conn.execute(f'DROP INDEX {name}')
+        client = server.app.test_client()
+        latencies, elapsed = measure_chats(client, tokens, args.requests)
+        results = [summarize('/api/chats (без индексов)', latencies, elapsed)]
+        with server.get_db() as conn:
+            t0 = time.perf_counter()
+            for _, sql in indexes:
+                conn.execute(sql)
+            print(f"Индексы построены за {time.perf_counter() - t0:.2f}с")
+        latencies, elapsed = measure_chats(client, tokens, args.requests)
+        results.append(summarize('/api/chats (с индексами)', latencies, elapsed))
+        print_results(results)
+        write_json(args.json, 'chats', vars(args), results)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def run_senders(name, senders, per_sender, chats, send):
+    import eventlet
+    latencies = []
+    
+    def sender(user_id):
+        rnd = random.Random(user_id)
+        for i in range(per_sender):
+            t0 = time.perf_counter()
+            message_id = send(rnd.randint(1, chats), user_id, f'bench {user_id}/{i}')
+            latencies.append(time.perf_counter() - t0)
+            assert message_id is not None
+    
+    pool = eventlet.GreenPool(senders)
+    started = time.perf_counter()
+    for user_id in range(1, senders + 1):
+        pool.spawn(sender, user_id)
+    pool.waitall()
+    return summarize(name, latencies, time.perf_counter() - started)
+
+def bench_messages(args):
+    tmp = use_temp_database(args.dir)
+    os.environ['VOX_DB_SYNCHRONOUS'] = args.synchronous
+    try:
+        import eventlet.event
+        import server
+        with server.get_db() as conn:
+            server.apply_migrations(conn)
+            seed_database(conn, args.senders, args.chats, args.senders, 0)
+        
+        # "до": INSERT + COMMIT на каждое сообщение, как делал handle_message раньше
+        def send_direct(chat_id, user_id, content):
+            with server.get_db() as conn:
+                c = conn.cursor()
+                c.execute("INSERT INTO messages (chat_id, user_id, content) VALUES (?, ?, ?)",
+                          (chat_id, user_id, content))
+                conn.commit()
+                return c.lastrowid
+        
+        writer = server.MessageWriter(lambda item, message_id: item[3].send(message_id),
+                                      args.batch_size, args.batch_latency_ms / 1000)
+        
+        def send_batched(chat_id, user_id, content):
+            done = eventlet.event.Event()
+            writer.submit(chat_id, user_id, content, done)
+            return done.wait()
+        
+        results = [
+            run_senders('коммит на сообщение', args.senders, args.per_sender, args.chats, send_direct),
+            run_senders('групповой коммит', args.senders, args.per_sender, args.chats, send_batched)
+        ]
+        print_results(results)
+        print(f"Писатель: {writer.stats()}")
+        write_json(args.json, 'messages', vars(args), results)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+# Сокет engineio без транспорта: только очередь исходящих, как у настоящего сокета.
+# Последний получатель комнаты сообщает о доставке через done.
+class BenchSocket:
+    def __init__(self, backlog=0, done=None):
+        import eventlet.queue
+        self.queue = eventlet.queue.Queue()
+        self.closed = False
+        self.done = done
+        for _ in range(backlog):
+            self.queue.put(None)
+    
+    def send(self, pkt):
+        self.queue.put(pkt)
+        if self.done is not None:
+            self.done()
+
+def run_fanout(name, server, room, members, slow, messages, send):
+    import eventlet
+    import eventlet.event
+    sio = server.socketio.server
+    waiter = [None]
+    for i in range(members):
+        last = i == members - 1
+        sio.eio.sockets[f'{room}-eio-{i}'] = BenchSocket(
+            server.FANOUT_QUEUE_LIMIT if i < slow else 0, (lambda: waiter[0].send()) if last else None)
+    
+    # Пробный гринлет: самый долгий промежуток между его запусками - простой цикла событий
+    stall = [0.0]
+    running = [True]
+    
+    def probe():
+        previous = time.perf_counter()
+        while running[0]:
+            eventlet.sleep(0)
+            now = time.perf_counter()
+            stall[0] = max(stall[0], now - previous)
+            previous = now
+    
+    # Сотни тысяч сокетов не должны попадать в сборку мусора посреди замера
+    gc.collect()
+    gc.freeze()
+    prober = eventlet.spawn(probe)
+    eventlet.sleep(0)
+    latencies = []
+    started = time.perf_counter()
+    for i in range(messages):
+        waiter[0] = eventlet.event.Event()
+        t0 = time.perf_counter()
+        send({'id': i, 'chat_id': 1, 'user_id': 1, 'content': f'bench {i}', 'type': 'text',
+              'file_path': None, 'timestamp': '2024-01-01T00:00:00'})
+        waiter[0].wait()
+        latencies.append(time.perf_counter() - t0)
+        eventlet.sleep(0)
+    elapsed = time.perf_counter() - started
+    running[0] = False
+    prober.wait()
+    gc.unfreeze()
+    result = summarize(f'{name}, {members} участников', latencies, elapsed)
+    result['stall_ms'] = round(stall[0] * 1000, 3)
+    return result
+
+def bench_fanout(args):
+    tmp = use_temp_database(args.dir)
+    try:
+        import server
+        sio = server.socketio.server
+        manager = sio.manager
+        results = []
+        for members in args.members:
+            room = f'bench-{members}'
+            for i in range(members):
+                manager.basic_enter_room(f'{room}-{i}', '/', room, eio_sid=f'{room}-eio-{i}')
+            slow = members * args.slow_percent // 100
+            # "до": один emit менеджера обходит всю комнату за раз на гринлете отправителя
+            results.append(run_fanout('emit', server, room, members, slow, args.messages,
+                                      lambda data: manager.emit('new_message', data, '/', room=room)))
+            results.append(run_fanout('fanout', server, room, members, slow, args.messages,
+                                      lambda data: server.fanout.emit('new_message', data, room)))
+            manager.rooms['/'].pop(room, None)
+            for i in range(members):
+                sio.eio.sockets.pop(f'{room}-eio-{i}', None)
+        print_results(results)
+        for r in results:
+            print(f"{r['name']:<32} макс. простой цикла {r['stall_ms']} мс")
+        print(f"Рассылка: {server.fanout.stats()}")
+        write_json(args.json, 'fanout', vars(args), results)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+SERVER_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+def wait_for_server(url, timeout=20):
+    import requests
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f'сервер {url} не запустился')
+
+# Нагрузку создаёт один адрес, поэтому лимиты запросов во временных серверах выключены
+NO_RATE_LIMITS = 'login=0:1,login_user=0:1,register=0:1,search=0:1,message=0:1'
+
+def start_server_process(tmp, name, env, extra_args=()):
+    log = open(os.path.join(tmp, f'{name}.log'), 'w')
+    env = dict({'VOX_RATE_LIMITS': NO_RATE_LIMITS}, **env)
+    # Своя группа процессов: при аварийной остановке добиваем и воркеров, и пул картинок
+    return subprocess.Popen([sys.executable, SERVER_PY] + list(extra_args), env=env,
+                            stdout=log, stderr=subprocess.STDOUT, cwd=tmp, start_new_session=True)
+
+def stop_processes(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            pass
+        # Добиваем всю группу: зависшие воркеры и осиротевшие процессы пула держат порт
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+def bench_cluster(args):
+    import requests
+    import socketio
+    tmp = use_temp_database()
+    env = dict(os.environ, VOX_MESSAGE_QUEUE=f'vox://127.0.0.1:{args.broker_port}')
+    urls = [f'http://127.0.0.1:{args.base_port + i}' for i in range(args.workers)]
+    processes = []
+    clients = []
+    try:
+        processes.append(start_server_process(tmp, 'broker', env, ['--broker']))
+        # Первый воркер применяет миграции, остальные стартуют уже на готовой схеме
+        for i, url in enumerate(urls):
+            worker_env = dict(env, PORT=str(args.base_port + i))
+            if i:
+                worker_env['VOX_WORKER_ID'] = str(i)
+            processes.append(start_server_process(tmp, f'worker{i}', worker_env))
+            wait_for_server(url)
+        
+        users = []
+        for i in range(args.workers * args.clients_per_worker):
+            url = urls[i % args.workers]
+            r = requests.post(f'{url}/api/register', json={'username': f'cluster{i}', 'password': 'secret1'}).json()
+            users.append((url, r['token'], r['user_id']))
+        
+        received = {}
+        for url, token, user_id in users:
+            client = socketio.Client()
+            received[user_id] = []
+            client.on('new_message', lambda data, user_id=user_id: received[user_id].append((time.time(), data)))
+            client.connect(url, auth={'token': token}, transports=['websocket'])
+            clients.append(client)
+        
+        # Чат создаётся после подключения: членство на других воркерах приходит через шину
+        owner_url, owner_token, _ = users[0]
+        chat_id = requests.post(f'{owner_url}/api/chats/create', json={
+            'token': owner_token, 'name': 'cluster', 'type': 'group',
+            'members': [f'cluster{i}' for i in range(1, len(users))]
+        }).json()['chat_id']
+        time.sleep(0.5)
+        for client in clients:
+            client.emit('join', {'chat_id': chat_id})
+        time.sleep(0.5)
+        
+        sent_at = {}
+        for i in range(args.messages):
+            content = f'cluster message {i}'
+            sent_at[content] = time.time()
+            clients[0].emit('message', {'chat_id': chat_id, 'content': content})
+        deadline = time.time() + args.timeout
+        expected = args.messages
+        while time.time() < deadline and any(len(r) < expected for r in received.values()):
+            time.sleep(0.05)
+        
+        results = []
+        failed = False
+        for i in range(args.workers):
+            worker_users = [u for j, u in enumerate(users) if j % args.workers == i]
+            latencies = [at - sent_at[data['content']] for _, _, user_id in worker_users
+                         for at, data in received[user_id]]
+            delivered = sum(len(received[user_id]) for _, _, user_id in worker_users)
+            wanted = expected * len(worker_users)
+            failed = failed or delivered < wanted
+            result = summarize(f'воркер {i}: {delivered}/{wanted}', latencies, 0)
+            result['delivered'] = delivered
+            result['expected'] = wanted
+            results.append(result)
+        print_results(results)
+        write_json(args.json, 'cluster', vars(args), results)
+        print('FAIL: сообщения дошли не до всех воркеров' if failed else 'OK: сообщения доставлены на все воркеры')
+        return 1 if failed else 0
+    finally:
+        for client in clients:
+            client.disconnect()
+        stop_processes(processes)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def seed_load_users(url, users, group_size, history):
+    import requests
+    accounts = []
+    http = requests.Session()
+    for i in range(users):
+        username = f'load{i}'
+        r = http.post(f'{url}/api/register', json={'username': username, 'password': 'secret1'}).json()
+        accounts.append({'username': username, 'password': 'secret1', 'token': r['token'], 'user_id': r['user_id']})
+    chats = []
+    for start in range(0, users, group_size):
+        group = accounts[start:start + group_size]
+        r = http.post(f'{url}/api/chats/create', json={
+            'token': group[0]['token'], 'name': f'load group {start // group_size}', 'type': 'group',
+            'members': [a['username'] for a in group[1:]]
+        }).json()
+        chats.append((r['chat_id'], group))
+    if history:
+        # История пишется напрямую в базу - через API это заняло бы минуты
+        import sqlite3
+        conn = sqlite3.connect(os.environ['VOX_DB_FILE'], timeout=30)
+        rnd = random.Random(1)
+        conn.executemany("INSERT INTO messages (chat_id, user_id, content) VALUES (?, ?, ?)",
+                         ((chat_id, rnd.choice(group)['user_id'], f'history {i}')
+                          for i in range(history) for chat_id, group in [rnd.choice(chats)]))
+        conn.execute("UPDATE chats SET last_message_id = (SELECT MAX(id) FROM messages WHERE chat_id = chats.id)")
+        conn.commit()
+        conn.close()
+    return accounts, chats
+
+REST_OPERATIONS = ('login', 'auto_login', 'chats')
+
+def rest_user(url, account, deadline, latencies, errors):
+    import requests
+    http = requests.Session()
+    rnd = random.Random(account['user_id'])
+    # Сервер держит не больше VOX_SESSION_MAX_PER_USER сессий: после входа старый токен
+    # может быть вытеснен, поэтому работаем с токеном последнего входа
+    token = account['token']
+    while time.time() < deadline:
+        op = rnd.choice(REST_OPERATIONS)
+        t0 = time.perf_counter()
+        try:
+            if op == 'login':
+                r = http.post(f'{url}/api/login', json={'username': account['username'], 'password': account['password']})
+                if r.status_code == 200:
+                    token = r.json()['token']
+            elif op == 'auto_login':
+                r = http.post(f'{url}/api/auto_login', json={'token': token})
+            else:
+                r = http.get(f'{url}/api/chats', params={'token': token})
+            ok = r.status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - t0
+        if ok:
+            latencies[op].append(elapsed)
+        else:
+            errors[op] = errors.get(op, 0) + 1
+
+def socket_load(url, chats, senders, receivers, rate, duration, errors):
+    import socketio
+    deliveries = []
+    sent = [0]
+    clients = []
+    chat_id, group = chats[0]
+    members = group[:senders + receivers]
+    if len(members) < senders + receivers:
+        raise RuntimeError('увеличьте --group-size: не хватает участников для отправителей и получателей')
+    
+    def on_message(data):
+        try:
+            deliveries.append(time.time() - float(data['content'].split('|', 1)[0]))
+        except ValueError:
+            pass
+    
+    for i, account in enumerate(members):
+        client = socketio.Client()
+        if i >= senders:
+            client.on('new_message', on_message)
+        client.connect(url, auth={'token': account['token']}, transports=['websocket'])
+        client.emit('join', {'chat_id': chat_id})
+        clients.append(client)
+    time.sleep(0.5)
+    
+    def sender(client):
+        interval = 1.0 / rate if rate else 0
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            try:
+                client.emit('message', {'chat_id': chat_id, 'content': f'{time.time()}|load'})
+                sent[0] += 1
+            except Exception:
+                errors['message'] = errors.get('message', 0) + 1
+            if interval:
+                time.sleep(interval)
+    
+    threads = [threading.Thread(target=sender, args=(c,)) for c in clients[:senders]]
+    started = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    time.sleep(1)
+    elapsed = time.time() - started
+    for client in clients:
+        client.disconnect()
+    result = summarize('доставка сообщения (e2e)', deliveries, elapsed)
+    result['sent'] = sent[0]
+    result['expected_deliveries'] = sent[0] * receivers
+    return result
+
+def bench_load(args):
+    tmp = use_temp_database()
+    processes = []
+    url = args.url
+    try:
+        if not url:
+            url = f'http://127.0.0.1:{args.port}'
+            env = dict(os.environ, PORT=str(args.port))
+            extra = ['--workers', str(args.server_workers)] if args.server_workers > 1 else []
+            processes.append(start_server_process(tmp, 'server', env, extra))
+            wait_for_server(url)
+        print(f"Заполнение: {args.users} пользователей, группы по {args.group_size}, {args.history} сообщений истории...")
+        accounts, chats = seed_load_users(url, args.users, args.group_size, args.history if not args.url else 0)
+        
+        latencies = {op: [] for op in REST_OPERATIONS}
+        errors = {}
+        deadline = time.time() + args.duration
+        threads = [threading.Thread(target=rest_user, args=(url, accounts[i % len(accounts)], deadline, latencies, errors))
+                   for i in range(args.rest_users)]
+        started = time.time()
+        for t in threads:
+            t.start()
+        
+        results = []
+        if args.senders:
+            results.append(socket_load(url, chats, args.senders, args.receivers, args.rate, args.duration, errors))
+        for t in threads:
+            t.join()
+        elapsed = time.time() - started
+        results[:0] = [summarize(f'/api/{op}', latencies[op], elapsed) for op in REST_OPERATIONS]
+        
+        print_results(results)
+        if errors:
+            print(f"Ошибки: {errors}")
+        write_json(args.json, 'load', vars(args), results, errors=errors)
+        return 1 if errors and args.fail_on_errors else 0
+    finally:
+        stop_processes(processes)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def upload_image(url, token):
+    import io
+    import requests
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (640, 480), 'teal').save(buffer, 'PNG')
+    data = buffer.getvalue()
+    upload = requests.post(f'{url}/api/uploads', json={'token': token, 'size': len(data), 'mime': 'image/png'}).json()
+    requests.put(f"{url}/api/uploads/{upload['upload_id']}", params={'token': token, 'offset': 0}, data=data)
+    return requests.post(f"{url}/api/uploads/{upload['upload_id']}/complete", json={'token': token}).json()['hash']
+
+# Остановка по SIGTERM после того, как сервер отрисовал картинки: пул процессов ImagePipeline
+# не должен держать воркер (а под --workers - и мастер, ждущий воркеров)
+def bench_shutdown(args):
+    import requests
+    tmp = use_temp_database()
+    processes = []
+    try:
+        url = f'http://127.0.0.1:{args.port}'
+        extra = ['--workers', str(args.server_workers)] if args.server_workers > 1 else []
+        server = start_server_process(tmp, 'server', dict(os.environ, PORT=str(args.port)), extra)
+        processes.append(server)
+        wait_for_server(url)
+        token = requests.post(f'{url}/api/register', json={'username': 'shutdown1', 'password': 'secret1'}).json()['token']
+        digest = upload_image(url, token)
+        # Под --workers запросы расходятся по процессам - рисуем варианты несколько раз
+        rendered = 0
+        for _ in range(args.server_workers):
+            for variant in ('thumb', 'preview', 'large'):
+                for image_format in ('webp', 'jpeg'):
+                    r = requests.get(f'{url}/api/images/{digest}/{variant}', timeout=30,
+                                     params={'token': token, 'format': image_format}, headers={'Connection': 'close'})
+                    rendered += r.status_code == 200
+        started = time.perf_counter()
+        server.terminate()
+        try:
+            server.wait(timeout=args.timeout)
+        except subprocess.TimeoutExpired:
+            print(f"Сервер не остановился за {args.timeout} с после SIGTERM ({rendered} картинок отрисовано)")
+            return 1
+        elapsed = time.perf_counter() - started
+        print(f"Остановка после SIGTERM: {elapsed * 1000:.1f} мс ({rendered} картинок отрисовано)")
+        write_json(args.json, 'shutdown', vars(args), [], shutdown_ms=round(elapsed * 1000, 3), rendered=rendered)
+        return 0
+    finally:
+        stop_processes(processes)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарки сервера Vox')
+    sub = parser.add_subparsers(dest='scenario', required=True)
+
+    p = sub.add_parser('chats', help='латентность /api/chats до и после индексов')
+    p.add_argument('--users', type=int, default=10000)
+    p.add_argument('--chats', type=int, default=20000)
+    p.add_argument('--memberships', type=int, default=100000)
+    p.add_argument('--messages', type=int, default=1000000)
+    p.add_argument('--requests', type=int, default=500)
+    p.add_argument('--json', help='записать результаты в JSON-файл')
+    p.set_defaults(func=bench_chats)
+
+    p = sub.add_parser('messages', help='сообщений/с: коммит на сообщение против группового коммита')
+    p.add_argument('--senders', type=int, default=1000)
+    p.add_argument('--per-sender', type=int, default=20)
+    p.add_argument('--chats', type=int, default=100)
+    p.add_argument('--batch-size', type=int, default=256)
+    p.add_argument('--batch-latency-ms', type=float, default=5)
+    p.add_argument('--synchronous', default='NORMAL', help='PRAGMA synchronous для соединений пула')
+    p.add_argument('--dir', help='каталог для временной базы (по умолчанию системный tmp)')
+    p.add_argument('--json', help='записать результаты в JSON-файл')
+    p.set_defaults(func=bench_messages)
+
+    p = sub.add_parser('fanout', help='доставка в большие комнаты: один emit против порционной рассылки')
+    p.add_argument('--members', type=int, nargs='+', default=[10000, 100000])
+    p.add_argument('--messages', type=int, default=20)
+    p.add_argument('--slow-percent', type=int, default=1, help='доля получателей с заполненной очередью')
+    p.add_argument('--dir', help='каталог для временной базы (по умолчанию системный tmp)')
+    p.add_argument('--json', help='записать результаты в JSON-файл')
+    p.set_defaults(func=bench_fanout)
+
+    p = sub.add_parser('cluster', help='N воркеров со встроенным брокером: доставка между процессами')
+    p.add_argument('--workers', type=int, default=3)
+    p.add_argument('--clients-per-worker', type=int, default=2)
+    p.add_argument('--messages', type=int, default=50)
+    p.add_argument('--base-port', type=int, default=5600)
+    p.add_argument('--broker-port', type=int, default=5599)
+    p.add_argument('--timeout', type=float, default=10)
+    p.add_argument('--json', help='записать результаты в JSON-файл')
+    p.set_defaults(func=bench_cluster)
+
+    p = sub.add_parser('load', help='нагрузочный тест: REST-пользователи и Socket.IO отправители/получатели')
+    p.add_argument('--url', help='нагружать уже запущенный сервер вместо временного')
+    p.add_argument('--port', type=int, default=5700)
+    p.add_argument('--server-workers', type=int, default=1)
+    p.add_argument('--users', type=int, default=200)
+    p.add_argument('--group-size', type=int, default=50)
+    p.add_argument('--history', type=int, default=100000)
+    p.add_argument('--rest-users', type=int, default=20)
+    p.add_argument('--senders', type=int, default=5)
+    p.add_argument('--receivers', type=int, default=20)
+    p.add_argument('--rate', type=float, default=20, help='сообщений/с на отправителя (0 - без паузы)')
+    p.add_argument('--duration', type=float, default=10)
+    p.add_argument('--fail-on-errors', action='store_true')
+    p.add_argument('--json', help='записать результаты в JSON-файл')
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser('shutdown', help='остановка по SIGTERM после отрисовки картинок')
+    p.add_argument('--port', type=int, default=5750)
+    p.add_argument('--server-workers', type=int, default=1)
+    p.add_argument('--timeout', type=float, default=5, help='сколько секунд ждать выхода')
+    p.add_argument('--json', help='записать результаты в JSON-файл')
+    p.set_defaults(func=bench_shutdown)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,16 +2,476 @@ import customtkinter as ctk
 import requests
 import json
 import os
+import sqlite3
 from tkinter import messagebox
 import threading
+import queue
+import time
 from PIL import Image
 import socketio
 
+try:
+    from plyer import notification
+except ImportError:
+    notification = None
+
 ctk.set_appearance_mode("dark")
 ctk.set_default_color_theme("blue")
 
 CONFIG_FILE = 'vox_config.json'
 SERVER_URL = 'http://localhost:5000'
+REQUEST_TIMEOUT = 5
+NETWORK_WORKERS = 4
+CACHE_FILE = 'vox_cache.db'
+CACHE_MESSAGES_PER_CHAT = 500
+CACHE_MAX_MESSAGES = 20000
+HISTORY_SYNC_LIMIT = 200
+CHAT_VIEW_MESSAGES = 100
+CHAT_ROW_HEIGHT = 56
+CHAT_LIST_OVERSCAN = 4
+CHAT_PREVIEW_LENGTH = 60
+NOTIFY_WINDOW = 2.0
+NOTIFY_BURST = 3
+NOTIFY_REFILL_INTERVAL = 10.0
+
+# Сетевой слой клиента: запросы выполняются в фоновых потоках через один requests.Session
+# (keep-alive, пул соединений), результат возвращается в поток Tk через root.after.
+# Запросы помечаются тегом; новый запрос или cancel() с тем же тегом делают прежние
+# устаревшими - их ответы отбрасываются, не трогая уже уничтоженные виджеты.
+class NetworkWorker:
+    def __init__(self, root, base_url, workers=NETWORK_WORKERS):
+        self.root = root
+        self.base_url = base_url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._queue = queue.Queue()
+        self._generations = {}
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+    
+    def request(self, method, path, on_success=None, on_error=None, tag=None, **kwargs):
+        generation = None
+        if tag is not None:
+            generation = self._generations.get(tag, 0) + 1
+            self._generations[tag] = generation
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        self._queue.put((method, path, kwargs, on_success, on_error, tag, generation))
+    
+    def get(self, path, **kwargs):
+        self.request('GET', path, **kwargs)
+    
+    def post(self, path, **kwargs):
+        self.request('POST', path, **kwargs)
+    
+    def cancel(self, tag=None):
+        tags = [tag] if tag is not None else list(self._generations)
+        for name in tags:
+            self._generations[name] = self._generations.get(name, 0) + 1
+    
+    def is_current(self, tag, generation):
+        return tag is None or self._generations.get(tag) == generation
+    
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            method, path, kwargs, on_success, on_error, tag, generation = item
+            if not self.is_current(tag, generation):
+                continue
+            try:
+                result = self.session.request(method, self.base_url + path, **kwargs)
+                callback = on_success
+            except requests.RequestException as e:
+                result = e
+                callback = on_error
+            if callback is not None:
+                self._deliver(callback, result, tag, generation)
+    
+    def _deliver(self, callback, result, tag, generation):
+        # Проверка актуальности повторяется в потоке Tk: cancel() мог случиться, пока ответ шёл
+        def run():
+            if self.is_current(tag, generation):
+                callback(result)
+        try:
+            self.root.after(0, run)
+        except RuntimeError:
+            pass
+    
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        self.session.close()
+
+# Локальный кэш чатов и последних сообщений (SQLite рядом с конфигом). Интерфейс рисуется
+# из кэша сразу, сервер догружается инкрементально: для каждого чата запрашиваются только
+# сообщения после отметки synced:<chat_id> в meta. Отметку двигает только загрузка истории:
+# сообщения из сокета могут прийти поверх пропуска, поэтому MAX(id) для догрузки не годится.
+# История ограничена по числу сообщений на чат и всего; освобождённые страницы файла
+# возвращаются через incremental_vacuum.
+# Все обращения идут из потока Tk.
+class LocalCache:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS chats (id INTEGER PRIMARY KEY, position INTEGER, data TEXT);
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER,
+                content TEXT,
+                type TEXT,
+                file_path TEXT,
+                created_at TEXT,
+                edited INTEGER DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id, id);
+        ''')
+    
+    def bind_user(self, user_id):
+        # Кэш принадлежит одному аккаунту: при входе под другим он очищается
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'user_id'").fetchone()
+        if row is None or row[0] != str(user_id):
+            self.clear()
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('user_id', ?)", (str(user_id),))
+            self.conn.commit()
+    
+    def clear(self):
+        self.conn.execute("DELETE FROM meta")
+        self.conn.execute("DELETE FROM chats")
+        self.conn.execute("DELETE FROM messages")
+        self.conn.commit()
+        self.conn.execute('PRAGMA incremental_vacuum')
+    
+    def load_chats(self):
+        return [json.loads(row[0]) for row in self.conn.execute("SELECT data FROM chats ORDER BY position")]
+    
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def save_chats(self, chats, etag=None):
+        # ETag относится ровно к этому телу ответа - сохраняем вместе с ним
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('chats_etag', ?)", (etag,))
+        self.conn.execute("DELETE FROM chats")
+        self.conn.executemany("INSERT INTO chats (id, position, data) VALUES (?, ?, ?)",
+                              [(chat['id'], i, json.dumps(chat, ensure_ascii=False)) for i, chat in enumerate(chats)])
+        # История чатов, из которых пользователь вышел, больше не нужна
+        self.conn.execute("DELETE FROM messages WHERE chat_id NOT IN (SELECT id FROM chats)")
+        self.conn.execute("""DELETE FROM meta WHERE key LIKE 'synced:%' 
+                             AND CAST(substr(key, 8) AS INTEGER) NOT IN (SELECT id FROM chats)""")
+        self.conn.commit()
+    
+    def get_chat(self, chat_id):
+        row = self.conn.execute("SELECT data FROM chats WHERE id = ?", (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def update_chat(self, chat, move_to_top=True):
+        if move_to_top:
+            self.conn.execute("""INSERT OR REPLACE INTO chats (id, position, data) 
+                                 VALUES (?, (SELECT COALESCE(MIN(position), 0) - 1 FROM chats), ?)""",
+                              (chat['id'], json.dumps(chat, ensure_ascii=False)))
+        else:
+            self.conn.execute("UPDATE chats SET data = ? WHERE id = ?",
+                              (json.dumps(chat, ensure_ascii=False), chat['id']))
+        # Локально изменённый список уже не совпадает с телом, к которому относился ETag
+        self.conn.execute("DELETE FROM meta WHERE key = 'chats_etag'")
+        self.conn.commit()
+    
+    def last_message_id(self, chat_id):
+        return self.conn.execute("SELECT MAX(id) FROM messages WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+    
+    def synced_up_to(self, chat_id):
+        value = self.get_meta(f'synced:{chat_id}')
+        return int(value) if value is not None else None
+    
+    def load_messages(self, chat_id, limit):
+        rows = self.conn.execute("""SELECT id, user_id, content, type, file_path, created_at, edited 
+                                    FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ?""",
+                                 (chat_id, limit)).fetchall()
+        rows.reverse()
+        return rows
+    
+    def save_messages(self, chat_id, rows, replace=False, synced=False):
+        if replace:
+            self.conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        if synced:
+            # Страница истории без пропусков: отметка встаёт на её последний id
+            synced_up_to = None if replace else self.synced_up_to(chat_id)
+            if rows:
+                synced_up_to = max(synced_up_to or 0, max(row[0] for row in rows))
+            if synced_up_to is None:
+                self.conn.execute("DELETE FROM meta WHERE key = ?", (f'synced:{chat_id}',))
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                  (f'synced:{chat_id}', str(synced_up_to)))
+        self.conn.executemany("""INSERT OR REPLACE INTO messages 
+                                 (id, chat_id, user_id, content, type, file_path, created_at, edited) 
+                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                              [(row[0], chat_id) + tuple(row[1:7]) for row in rows])
+        self.evict(chat_id)
+        self.conn.commit()
+    
+    def add_message(self, message):
+        self.save_messages(message['chat_id'], [(message['id'], message['user_id'], message['content'],
+                                                 message.get('type', 'text'), message.get('file_path'),
+                                                 message.get('timestamp'), 0)])
+    
+    def evict(self, chat_id):
+        self.conn.execute("""DELETE FROM messages WHERE chat_id = ? AND id <= (
+                                 SELECT id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)""",
+                          (chat_id, chat_id, CACHE_MESSAGES_PER_CHAT))
+        total = self.conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        if total > CACHE_MAX_MESSAGES:
+            self.conn.execute("DELETE FROM messages WHERE id IN (SELECT id FROM messages ORDER BY id LIMIT ?)",
+                              (total - CACHE_MAX_MESSAGES,))
+            self.conn.commit()
+            self.conn.execute('PRAGMA incremental_vacuum')
+    
+    def close(self):
+        self.conn.close()
+
+def messages_word(count):
+    if count % 10 == 1 and count % 100 != 11:
+        return "новое сообщение"
+    if count % 10 in (2, 3, 4) and count % 100 not in (12, 13, 14):
+        return "новых сообщения"
+    return "новых сообщений"
+
+# Агрегатор уведомлений: сообщения копятся по чатам в окне NOTIFY_WINDOW секунд с первого
+# сообщения пачки, затем показывается одна сводка на чат. Глобальный лимит - token bucket
+# (NOTIFY_BURST подряд, дальше одно уведомление в NOTIFY_REFILL_INTERVAL); пока лимит
+# исчерпан, пачки продолжают копиться. Показ идёт в собственном потоке, поэтому медленный
+# системный вызов уведомления не задерживает ни Tk, ни поток Socket.IO.
+class NotificationAggregator:
+    def __init__(self, is_suppressed, window=NOTIFY_WINDOW, burst=NOTIFY_BURST, refill_interval=NOTIFY_REFILL_INTERVAL):
+        self.is_suppressed = is_suppressed
+        self.window = window
+        self.burst = burst
+        self.refill_interval = refill_interval
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def add(self, chat_id, chat_name, content):
+        self._queue.put((chat_id, chat_name, content))
+    
+    def close(self):
+        self._queue.put(None)
+    
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self._wait_time())
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                chat_id, chat_name, content = item
+                batch = self._pending.get(chat_id)
+                if batch is None:
+                    self._pending[chat_id] = [time.monotonic(), 1, chat_name, content]
+                else:
+                    batch[1] += 1
+                    batch[2] = chat_name
+                    batch[3] = content
+            self._flush_due()
+    
+    def _refill(self, now):
+        added = int((now - self.refilled_at) / self.refill_interval)
+        if added:
+            self.tokens = min(self.tokens + added, self.burst)
+            self.refilled_at = now if self.tokens == self.burst else self.refilled_at + added * self.refill_interval
+    
+    def _wait_time(self):
+        if not self._pending:
+            return None
+        now = time.monotonic()
+        wait = min(batch[0] + self.window for batch in self._pending.values()) - now
+        if self.tokens == 0:
+            wait = max(wait, self.refilled_at + self.refill_interval - now)
+        return max(wait, 0.05)
+    
+    def _flush_due(self):
+        now = time.monotonic()
+        self._refill(now)
+        for chat_id in sorted((c for c, b in self._pending.items() if now - b[0] >= self.window),
+                              key=lambda c: self._pending[c][0]):
+            if self.is_suppressed(chat_id):
+                del self._pending[chat_id]
+                continue
+            if self.tokens == 0:
+                break
+            self.tokens -= 1
+            _, count, chat_name, content = self._pending.pop(chat_id)
+            if count == 1:
+                self._notify(chat_name, content)
+            else:
+                self._notify(f"{count} {messages_word(count)} в {chat_name}", content)
+    
+    def _notify(self, title, message):
+        if notification is None:
+            return
+        try:
+            notification.notify(
+                title=title,
+                message=message[:200],
+                app_name='Vox Messenger',
+                timeout=5
+            )
+        except Exception:
+            pass
+
+def chat_row_text(chat):
+    text = chat['name']
+    if chat.get('unread'):
+        text += f"  ({chat['unread']})"
+    last_message = chat.get('last_message')
+    if last_message and last_message.get('content'):
+        text += "\n" + last_message['content'].replace("\n", " ")[:CHAT_PREVIEW_LENGTH]
+    return text
+
+class ChatRow:
+    __slots__ = ('window', 'button', 'index', 'key', 'width')
+    
+    def __init__(self, window, button):
+        self.window = window
+        self.button = button
+        self.index = None
+        self.key = None
+        self.width = None
+
+# Виртуальный список чатов: виджеты существуют только для видимых строк и небольшого запаса
+# (overscan), при прокрутке те же кнопки переставляются на новые позиции холста и получают
+# новый текст. Строка перенастраивается, только если её содержимое изменилось, поэтому
+# обновление одного чата трогает одну строку, а не весь экран.
+class VirtualChatList(ctk.CTkFrame):
+    def __init__(self, master, on_select, empty_text, row_height=CHAT_ROW_HEIGHT, overscan=CHAT_LIST_OVERSCAN, **kwargs):
+        super().__init__(master, **kwargs)
+        self.on_select = on_select
+        self.row_height = row_height
+        self.overscan = overscan
+        self.items = []
+        self.positions = {}
+        self.rows = []
+        
+        self.canvas = ctk.CTkCanvas(self, highlightthickness=0, yscrollincrement=row_height,
+                                    bg=self._apply_appearance_mode(self.cget('fg_color')))
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self._on_scroll)
+        self.scrollbar.pack(side='right', fill='y')
+        self.canvas.pack(side='left', fill='both', expand=True)
+        self.empty_label = ctk.CTkLabel(self, text=empty_text, font=("Arial", 14))
+        
+        self.canvas.bind('<Configure>', lambda event: self.refresh())
+        self._bind_wheel(self.canvas)
+    
+    def _bind_wheel(self, widget):
+        widget.bind('<MouseWheel>', self._on_wheel)
+        widget.bind('<Button-4>', self._on_wheel)
+        widget.bind('<Button-5>', self._on_wheel)
+    
+    def _on_wheel(self, event):
+        step = -3 if event.num == 4 or getattr(event, 'delta', 0) > 0 else 3
+        self.canvas.yview_scroll(step, 'units')
+    
+    def _on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self.refresh()
+    
+    def _reindex(self, start=0, stop=None):
+        for index in range(start, len(self.items) if stop is None else stop):
+            self.positions[self.items[index]['id']] = index
+    
+    def set_items(self, items):
+        self.items = list(items)
+        self.positions = {}
+        self._reindex()
+        self._items_resized()
+    
+    def _items_resized(self):
+        self.canvas.configure(scrollregion=(0, 0, 0, len(self.items) * self.row_height))
+        if self.items:
+            self.empty_label.place_forget()
+        else:
+            self.empty_label.place(relx=0.5, rely=0.3, anchor='center')
+        self.refresh()
+    
+    def get_item(self, item_id):
+        index = self.positions.get(item_id)
+        return self.items[index] if index is not None else None
+    
+    def update_item(self, item, move_to_top=False):
+        index = self.positions.get(item['id'])
+        if index is None:
+            self.items.insert(0, item)
+            self._reindex()
+            self._items_resized()
+            return
+        if move_to_top and index != 0:
+            # Сдвигаются только строки выше прежней позиции; видимые перерисуются по изменившимся ключам
+            del self.items[index]
+            self.items.insert(0, item)
+            self._reindex(0, index + 1)
+            self.refresh()
+            return
+        self.items[index] = item
+        for row in self.rows:
+            if row.index == index:
+                self._show(row, index, row.width)
+    
+    def _add_row(self):
+        slot = len(self.rows)
+        button = ctk.CTkButton(self.canvas, height=self.row_height - 6, anchor='w',
+                               command=lambda: self._select(slot))
+        self._bind_wheel(button)
+        window = self.canvas.create_window(0, 0, anchor='nw', window=button, state='hidden')
+        self.rows.append(ChatRow(window, button))
+    
+    def _select(self, slot):
+        index = self.rows[slot].index
+        if index is not None and index < len(self.items):
+            self.on_select(self.items[index])
+    
+    def refresh(self):
+        height = max(self.canvas.winfo_height(), self.row_height)
+        width = self.canvas.winfo_width()
+        first = max(int(self.canvas.canvasy(0) // self.row_height) - self.overscan, 0)
+        count = max(min(height // self.row_height + 2 + 2 * self.overscan, len(self.items) - first), 0)
+        while len(self.rows) < count:
+            self._add_row()
+        for slot, row in enumerate(self.rows):
+            if slot < count:
+                self._show(row, first + slot, width)
+            elif row.index is not None:
+                self.canvas.itemconfigure(row.window, state='hidden')
+                row.index = None
+    
+    def _show(self, row, index, width):
+        item = self.items[index]
+        key = (item['id'], chat_row_text(item))
+        if row.index != index:
+            if row.index is None:
+                self.canvas.itemconfigure(row.window, state='normal')
+            self.canvas.coords(row.window, 0, index * self.row_height + 3)
+            row.index = index
+        if row.width != width:
+            self.canvas.itemconfigure(row.window, width=width)
+            row.width = width
+        if row.key != key:
+            row.button.configure(text=key[1])
+            row.key = key
 
 class VoxMessenger:
     def __init__(self):
@@ -28,35 +488,69 @@ class VoxMessenger:
         self.language = 'ru'
         self.bg_color = '#1a1a1a'
         
+        self.net = NetworkWorker(self.root, SERVER_URL)
+        self.cache = LocalCache(CACHE_FILE)
+        self.main_screen_active = False
+        self.open_chat_id = None
+        self.chat_list = None
+        self.notifier = NotificationAggregator(lambda chat_id: chat_id == self.open_chat_id)
         self.sio = socketio.Client()
+        self.sio_connecting = False
         self.setup_socketio()
         
         self.load_config()
         
         if self.token:
-            if self.auto_login():
+            # Профиль и чаты из кэша показываем сразу, токен проверяется в фоне
+            if self.user_id is not None:
                 self.show_main_screen()
             else:
-                self.show_login_screen()
+                self.show_loading_screen("Вход...")
+            self.auto_login()
         else:
             self.show_login_screen()
     
     def setup_socketio(self):
         @self.sio.on('new_message')
         def on_new_message(data):
-            self.show_desktop_notification(f"Новое сообщение", data['content'])
+            # Поток Socket.IO только передаёт событие в Tk и сразу возвращается
+            self.root.after(0, self.on_new_message, data)
+        
+        @self.sio.on('resync')
+        def on_resync(data):
+            self.root.after(0, self.on_resync, data)
     
-    def show_desktop_notification(self, title, message):
-        try:
-            from plyer import notification
-            notification.notify(
-                title=title,
-                message=message,
-                app_name='Vox Messenger',
-                timeout=5
-            )
-        except:
-            pass
+    def on_resync(self, data):
+        # Сервер пропустил часть сообщений (мы не успевали читать) - берём свежую страницу
+        if self.user_id is None:
+            return
+        for chat_id in data.get('chat_ids', []):
+            self.sync_chat(chat_id, None, lambda chat_id=chat_id: self.redraw_chat(chat_id))
+    
+    def on_new_message(self, data):
+        if self.user_id is None:
+            return
+        self.cache.add_message(data)
+        if data['chat_id'] == self.open_chat_id:
+            self.append_messages([(data['id'], data['user_id'], data['content'])])
+            if data['user_id'] != self.user_id:
+                self.mark_read(data['chat_id'], data['id'])
+        
+        # Чат с новым сообщением поднимается наверх: в списке и в кэше меняется одна строка
+        chat = self.chat_list.get_item(data['chat_id']) if self.chat_list is not None else None
+        if chat is None:
+            chat = self.cache.get_chat(data['chat_id'])
+        if data['user_id'] != self.user_id and data['chat_id'] != self.open_chat_id:
+            self.notifier.add(data['chat_id'], chat['name'] if chat else "Vox Messenger", data['content'] or "Вложение")
+        if chat is None:
+            return
+        chat = dict(chat, last_message={'id': data['id'], 'user_id': data['user_id'], 'content': data['content'],
+                                        'type': data.get('type', 'text'), 'created_at': data.get('timestamp')})
+        if data['user_id'] != self.user_id and data['chat_id'] != self.open_chat_id:
+            chat['unread'] = chat.get('unread', 0) + 1
+        self.cache.update_chat(chat)
+        if self.chat_list is not None:
+            self.chat_list.update_item(chat, move_to_top=True)
     
     def load_config(self):
         if os.path.exists(CONFIG_FILE):
@@ -65,40 +559,78 @@ class VoxMessenger:
                 self.token = config.get('token')
                 self.language = config.get('language', 'ru')
                 self.bg_color = config.get('bg_color', '#1a1a1a')
+                user = config.get('user') or {}
+                self.username = user.get('username')
+                self.user_id = user.get('user_id')
+                self.role = user.get('role')
+                self.verified = user.get('verified', False)
     
     def save_config(self):
         config = {
             'token': self.token,
             'language': self.language,
-            'bg_color': self.bg_color
+            'bg_color': self.bg_color,
+            'user': {
+                'username': self.username,
+                'user_id': self.user_id,
+                'role': self.role,
+                'verified': self.verified
+            } if self.user_id is not None else None
         }
         with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
             json.dump(config, f)
     
     def clear_window(self):
+        self.net.cancel()
+        self.main_screen_active = False
+        self.open_chat_id = None
+        self.chat_list = None
         for widget in self.root.winfo_children():
             widget.destroy()
     
+    def clear_content(self):
+        # Ответы запросов прежнего экрана больше не нужны
+        self.net.cancel('screen')
+        self.open_chat_id = None
+        self.chat_list = None
+        for widget in self.content_frame.winfo_children():
+            widget.destroy()
+    
+    def show_loading_screen(self, text):
+        self.clear_window()
+        ctk.CTkLabel(self.root, text=text, font=("Arial", 18)).pack(expand=True)
+    
     def auto_login(self):
-        try:
-            response = requests.post(f'{SERVER_URL}/api/auto_login', 
-                                    json={'token': self.token},
-                                    timeout=5)
+        def on_success(response):
             if response.status_code == 200:
                 data = response.json()
                 if data['success']:
-                    self.username = data['username']
-                    self.user_id = data['user_id']
-                    self.role = data['role']
-                    self.verified = data['verified']
-                    return True
+                    self.set_user(data)
+                    self.save_config()
+                    if not self.main_screen_active:
+                        self.show_main_screen()
+                    return
             elif response.status_code == 403:
                 data = response.json()
                 if data.get('error') == 'banned':
                     self.show_ban_notification(data.get('reason', 'Нарушение правил'))
-            return False
-        except:
-            return False
+                    return
+            self.show_login_screen()
+        
+        def on_error(error):
+            # Сервер недоступен: остаёмся на данных из кэша
+            if not self.main_screen_active:
+                self.show_login_screen()
+        
+        self.net.post('/api/auto_login', json={'token': self.token}, tag='auth',
+                      on_success=on_success, on_error=on_error)
+    
+    def set_user(self, data):
+        self.username = data['username']
+        self.user_id = data['user_id']
+        self.role = data.get('role', 'user')
+        self.verified = data.get('verified', False)
+        self.cache.bind_user(self.user_id)
     
     def show_ban_notification(self, reason):
         self.clear_window()
@@ -143,11 +675,22 @@ class VoxMessenger:
         btn_frame = ctk.CTkFrame(frame, fg_color="transparent")
         btn_frame.pack(pady=20)
         
-        ctk.CTkButton(btn_frame, text="Войти", command=self.login,
-                     width=140, height=40).pack(side='left', padx=5)
+        self.login_button = ctk.CTkButton(btn_frame, text="Войти", command=self.login,
+                                          width=140, height=40)
+        self.login_button.pack(side='left', padx=5)
         
-        ctk.CTkButton(btn_frame, text="Регистрация", command=self.register,
-                     width=140, height=40).pack(side='left', padx=5)
+        self.register_button = ctk.CTkButton(btn_frame, text="Регистрация", command=self.register,
+                                             width=140, height=40)
+        self.register_button.pack(side='left', padx=5)
+    
+    def set_auth_busy(self, busy, text=None):
+        state = 'disabled' if busy else 'normal'
+        self.login_button.configure(state=state, text=text or "Войти")
+        self.register_button.configure(state=state)
+    
+    def connection_error(self, error):
+        self.set_auth_busy(False)
+        messagebox.showerror("Ошибка", f"Не удалось подключиться к серверу: {error}")
     
     def login(self):
         username = self.login_username.get().strip()
@@ -157,19 +700,13 @@ class VoxMessenger:
             messagebox.showerror("Ошибка", "Заполните все поля")
             return
         
-        try:
-            response = requests.post(f'{SERVER_URL}/api/login',
-                                    json={'username': username, 'password': password},
-                                    timeout=5)
-            
+        def on_success(response):
+            self.set_auth_busy(False)
             if response.status_code == 200:
                 data = response.json()
                 if data['success']:
                     self.token = data['token']
-                    self.username = data['username']
-                    self.user_id = data['user_id']
-                    self.role = data['role']
-                    self.verified = data['verified']
+                    self.set_user(data)
                     self.save_config()
                     self.show_main_screen()
             elif response.status_code == 403:
@@ -179,8 +716,10 @@ class VoxMessenger:
             else:
                 data = response.json()
                 messagebox.showerror("Ошибка", data.get('error', 'Ошибка входа'))
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось подключиться к серверу: {e}")
+        
+        self.set_auth_busy(True, "Вход...")
+        self.net.post('/api/login', json={'username': username, 'password': password}, tag='auth',
+                      on_success=on_success, on_error=self.connection_error)
     
     def register(self):
         username = self.login_username.get().strip()
@@ -194,35 +733,32 @@ class VoxMessenger:
             messagebox.showerror("Ошибка", "Пароль должен быть минимум 6 символов")
             return
         
-        try:
-            response = requests.post(f'{SERVER_URL}/api/register',
-                                    json={'username': username, 'password': password},
-                                    timeout=5)
-            
+        def on_success(response):
+            self.set_auth_busy(False)
             if response.status_code == 200:
                 data = response.json()
                 if data['success']:
                     self.token = data['token']
-                    self.username = data['username']
-                    self.user_id = data['user_id']
+                    self.set_user(data)
                     self.save_config()
                     messagebox.showinfo("Успех", "Регистрация успешна!")
                     self.show_main_screen()
             else:
                 data = response.json()
                 messagebox.showerror("Ошибка", data.get('error', 'Ошибка регистрации'))
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось подключиться к серверу: {e}")
+        
+        self.set_auth_busy(True, "Регистрация...")
+        self.net.post('/api/register', json={'username': username, 'password': password}, tag='auth',
+                      on_success=on_success, on_error=self.connection_error)
     
     def show_main_screen(self):
         self.clear_window()
+        self.main_screen_active = True
         
-        # Подключаемся к Socket.IO
-        try:
-            if not self.sio.connected:
-                self.sio.connect(SERVER_URL)
-        except:
-            pass
+        # Подключаемся к Socket.IO в фоне: connect блокирует до рукопожатия
+        if not self.sio.connected and not self.sio_connecting:
+            self.sio_connecting = True
+            threading.Thread(target=self.connect_socket, daemon=True).start()
         
         # Левая панель - меню
         left_panel = ctk.CTkFrame(self.root, width=200)
@@ -277,37 +813,132 @@ class VoxMessenger:
         
         self.show_chats()
     
+    def connect_socket(self):
+        try:
+            # Только websocket: long-polling требует липких сессий при нескольких воркерах
+            self.sio.connect(SERVER_URL, auth={'token': self.token}, transports=['websocket'])
+        except Exception:
+            pass
+        finally:
+            self.sio_connecting = False
+    
     def show_chats(self):
-        for widget in self.content_frame.winfo_children():
-            widget.destroy()
+        self.clear_content()
         
         ctk.CTkLabel(self.content_frame, text="Чаты", 
                     font=("Arial", 24, "bold")).pack(pady=20)
         
-        try:
-            response = requests.get(f'{SERVER_URL}/api/chats',
-                                   params={'token': self.token},
-                                   timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                chats = data.get('chats', [])
-                
-                if not chats:
-                    ctk.CTkLabel(self.content_frame, text="У вас пока нет чатов",
-                                font=("Arial", 14)).pack(pady=20)
-                else:
-                    for chat in chats:
-                        chat_btn = ctk.CTkButton(self.content_frame, 
-                                                text=chat['name'],
-                                                width=400, height=50)
-                        chat_btn.pack(pady=5)
-        except:
-            ctk.CTkLabel(self.content_frame, text="Ошибка загрузки чатов",
-                        font=("Arial", 14)).pack(pady=20)
+        status = ctk.CTkLabel(self.content_frame, text="Обновление...",
+                              font=("Arial", 12))
+        status.pack()
+        
+        self.chat_list = VirtualChatList(self.content_frame, on_select=self.show_chat,
+                                         empty_text="У вас пока нет чатов")
+        self.chat_list.pack(fill='both', expand=True, padx=10, pady=10)
+        
+        # Сначала кэш - список виден сразу, даже без сети
+        cached = self.cache.load_chats()
+        self.chat_list.set_items(cached)
+        
+        def on_success(response):
+            if response.status_code == 304:
+                # Список не менялся: кэш уже на экране, тело не передавалось
+                status.configure(text="")
+                return
+            if response.status_code != 200:
+                on_error(None)
+                return
+            chats = response.json().get('chats', [])
+            self.cache.save_chats(chats, response.headers.get('ETag'))
+            status.configure(text="")
+            self.chat_list.set_items(chats)
+            self.sync_messages(chats)
+        
+        def on_error(error):
+            status.configure(text="Нет связи с сервером - показаны сохранённые данные" if cached
+                             else "Ошибка загрузки чатов")
+        
+        etag = self.cache.get_meta('chats_etag') if cached else None
+        self.net.get('/api/chats', params={'token': self.token}, tag='screen',
+                     headers={'If-None-Match': etag} if etag else None,
+                     on_success=on_success, on_error=on_error)
+    
+    def sync_messages(self, chats):
+        # Догружаем только чаты, где на сервере есть сообщения новее загруженной истории
+        for chat in chats:
+            last_message = chat.get('last_message')
+            if not last_message:
+                continue
+            synced_id = self.cache.synced_up_to(chat['id'])
+            if synced_id is None or synced_id < last_message['id']:
+                self.sync_chat(chat['id'], synced_id)
+    
+    def sync_chat(self, chat_id, after_id, on_done=None):
+        def on_success(response):
+            if response.status_code != 200:
+                return
+            data = response.json()
+            if after_id is not None and data.get('has_more'):
+                # Разрыв больше одной страницы: старую историю сбрасываем, берём последнюю страницу
+                self.sync_chat(chat_id, None, on_done)
+                return
+            self.cache.save_messages(chat_id, data.get('messages', []), replace=after_id is None, synced=True)
+            if on_done is not None:
+                on_done()
+        
+        params = {'token': self.token, 'limit': HISTORY_SYNC_LIMIT}
+        if after_id is not None:
+            params['after_id'] = after_id
+        self.net.get(f'/api/chats/{chat_id}/messages', params=params, tag=f'sync:{chat_id}',
+                     on_success=on_success)
+    
+    def redraw_chat(self, chat_id):
+        if self.open_chat_id != chat_id:
+            return
+        self.message_box.configure(state='normal')
+        self.message_box.delete("1.0", "end")
+        self.message_box.configure(state='disabled')
+        self.append_messages(self.cache.load_messages(chat_id, CHAT_VIEW_MESSAGES))
+    
+    def show_chat(self, chat):
+        self.clear_content()
+        self.open_chat_id = chat['id']
+        
+        ctk.CTkLabel(self.content_frame, text=chat['name'], 
+                    font=("Arial", 20, "bold")).pack(pady=10)
+        
+        self.message_box = ctk.CTkTextbox(self.content_frame, state='disabled', wrap='word')
+        self.message_box.pack(fill='both', expand=True, padx=10, pady=10)
+        
+        self.append_messages(self.cache.load_messages(chat['id'], CHAT_VIEW_MESSAGES))
+        
+        def on_synced():
+            self.redraw_chat(chat['id'])
+            self.mark_read(chat['id'], self.cache.last_message_id(chat['id']))
+        
+        self.sync_chat(chat['id'], self.cache.synced_up_to(chat['id']), on_synced)
+    
+    def mark_read(self, chat_id, message_id):
+        # Счётчик сбрасывается сразу, без ожидания ответа; место чата в списке не меняется
+        chat = self.cache.get_chat(chat_id)
+        if chat is not None and chat.get('unread'):
+            chat = dict(chat, unread=0)
+            self.cache.update_chat(chat, move_to_top=False)
+            if self.chat_list is not None:
+                self.chat_list.update_item(chat)
+        if message_id is not None:
+            self.net.post(f'/api/chats/{chat_id}/read', json={'token': self.token, 'message_id': message_id})
+    
+    def append_messages(self, rows):
+        self.message_box.configure(state='normal')
+        for row in rows:
+            author = "Вы" if row[1] == self.user_id else f"#{row[1]}"
+            self.message_box.insert('end', f"{author}: {row[2] or ''}\n")
+        self.message_box.configure(state='disabled')
+        self.message_box.see('end')
     
     def show_bots(self):
-        for widget in self.content_frame.winfo_children():
-            widget.destroy()
+        self.clear_content()
         
         ctk.CTkLabel(self.content_frame, text="Боты", 
                     font=("Arial", 24, "bold")).pack(pady=20)
@@ -319,8 +950,7 @@ class VoxMessenger:
                      width=200, height=40).pack(pady=20)
     
     def show_premium(self):
-        for widget in self.content_frame.winfo_children():
-            widget.destroy()
+        self.clear_content()
         
         ctk.CTkLabel(self.content_frame, text="💎 Vox Premium", 
                     font=("Arial", 24, "bold")).pack(pady=20)
@@ -344,8 +974,7 @@ class VoxMessenger:
                      text_color="black").pack(pady=30)
     
     def show_support_screen(self):
-        for widget in self.content_frame.winfo_children():
-            widget.destroy()
+        self.clear_content()
         
         ctk.CTkLabel(self.content_frame, text="🆘 Поддержка", 
                     font=("Arial", 24, "bold")).pack(pady=20)
@@ -370,24 +999,31 @@ class VoxMessenger:
                 messagebox.showerror("Ошибка", "Заполните все поля")
                 return
             
-            try:
-                response = requests.post(f'{SERVER_URL}/api/support/create',
-                                        json={'token': self.token, 'subject': subject, 'message': message},
-                                        timeout=5)
+            def on_success(response):
+                send_button.configure(state='normal', text="Отправить")
                 if response.status_code == 200:
                     messagebox.showinfo("Успех", "Обращение отправлено!")
                     subject_entry.delete(0, 'end')
                     message_text.delete("1.0", "end")
-            except:
+                else:
+                    on_error(None)
+            
+            def on_error(error):
+                send_button.configure(state='normal', text="Отправить")
                 messagebox.showerror("Ошибка", "Не удалось отправить обращение")
-        
-        ctk.CTkButton(self.content_frame, text="Отправить",
-                     command=send_ticket,
-                     width=200, height=40).pack(pady=20)
+            
+            send_button.configure(state='disabled', text="Отправка...")
+            self.net.post('/api/support/create', tag='screen',
+                          json={'token': self.token, 'subject': subject, 'message': message},
+                          on_success=on_success, on_error=on_error)
+        
+        send_button = ctk.CTkButton(self.content_frame, text="Отправить",
+                                    command=send_ticket,
+                                    width=200, height=40)
+        send_button.pack(pady=20)
     
     def show_admin_panel(self):
-        for widget in self.content_frame.winfo_children():
-            widget.destroy()
+        self.clear_content()
         
         ctk.CTkLabel(self.content_frame, text="⚙️ Админ панель", 
                     font=("Arial", 24, "bold")).pack(pady=20)
@@ -405,8 +1041,7 @@ class VoxMessenger:
                      width=300, height=50).pack(pady=10)
     
     def show_settings(self):
-        for widget in self.content_frame.winfo_children():
-            widget.destroy()
+        self.clear_content()
         
         ctk.CTkLabel(self.content_frame, text="⚙️ Настройки", 
                     font=("Arial", 24, "bold")).pack(pady=20)
@@ -444,16 +1079,14 @@ class VoxMessenger:
                      width=200, height=40).pack(pady=20)
     
     def logout(self):
-        try:
-            requests.post(f'{SERVER_URL}/api/logout',
-                         json={'token': self.token},
-                         timeout=5)
-        except:
-            pass
+        # Ответ не нужен: сессия на клиенте сбрасывается сразу
+        self.net.cancel()
+        self.net.post('/api/logout', json={'token': self.token})
         
         self.token = None
         self.username = None
         self.user_id = None
+        self.cache.clear()
         self.save_config()
         
         if self.sio.connected:
@@ -462,7 +1095,12 @@ class VoxMessenger:
         self.show_login_screen()
     
     def run(self):
-        self.root.mainloop()
+        try:
+            self.root.mainloop()
+        finally:
+            self.net.close()
+            self.notifier.close()
+            self.cache.close()
 
 if __name__ == '__main__':
     app = VoxMessenger()
@@ -1,148 +1,1414 @@
-from flask import Flask, request, jsonify
+import eventlet
+eventlet.monkey_patch()
+import eventlet.event
+import eventlet.patcher
+import eventlet.semaphore
+from eventlet import tpool
+
+from flask import Flask, request, jsonify, send_file
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+from socketio import PubSubManager, RedisManager, KombuManager
+from socketio import packet as socketio_packet
+from engineio import packet as engineio_packet
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from PIL import Image, ImageOps, UnidentifiedImageError
 import sqlite3
 import hashlib
+import hmac
+import ipaddress
 import secrets
 import datetime
+import argparse
+import bisect
+import math
+import json
+import multiprocessing
 import os
+import pickle
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import queue
+import threading
+import time
+import urllib.parse
+
+# Масштабирование на несколько процессов/узлов: комнаты Socket.IO общие через очередь
+# сообщений. VOX_MESSAGE_QUEUE: vox://host:port или vox+unix:///path - встроенный брокер,
+# redis://... или amqp://... - внешний (нужен пакет redis или kombu).
+MESSAGE_QUEUE = os.environ.get('VOX_MESSAGE_QUEUE', '')
+MESSAGE_QUEUE_CHANNEL = 'flask-socketio'
+DEFAULT_BROKER_URL = 'vox://127.0.0.1:5100'
+BROKER_SECRET = os.environ.get('VOX_BROKER_SECRET', '')
+BROKER_MAX_FRAME = 16 * 1024 * 1024
+BROKER_PEER_QUEUE = int(os.environ.get('VOX_BROKER_PEER_QUEUE', 10000))
+
+def parse_broker_url(url):
+    if url.startswith('vox+unix://'):
+        return socket.AF_UNIX, url[len('vox+unix://'):]
+    host, _, port = url[len('vox://'):].rstrip('/').rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+# Без секрета брокер принимает любого, кто достучится до порта, а по шине ходят баны и
+# сброс сессий. Поэтому пустой VOX_BROKER_SECRET допустим только на loopback и unix-сокете.
+def check_broker_secret(url, secret):
+    family, address = parse_broker_url(url)
+    if secret or family == socket.AF_UNIX:
+        return
+    host = address[0].strip('[]')
+    try:
+        loopback = ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        loopback = host == 'localhost'
+    if not loopback:
+        raise RuntimeError(f'VOX_BROKER_SECRET не задан: брокер {url} доступен не только с этой машины')
+
+def send_frame(sock, payload):
+    sock.sendall(struct.pack('>I', len(payload)) + payload)
+
+def recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError('broker connection closed')
+        buf += chunk
+    return bytes(buf)
+
+def recv_frame(sock):
+    size = struct.unpack('>I', recv_exact(sock, 4))[0]
+    if size > BROKER_MAX_FRAME:
+        raise ConnectionError('broker frame too large')
+    return recv_exact(sock, size)
+
+def connect_broker(url):
+    family, address = parse_broker_url(url)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    send_frame(sock, BROKER_SECRET.encode())
+    return sock
+
+# Встроенный брокер: каждый кадр от одного подключения рассылается всем остальным.
+# У каждого подписчика своя ограниченная очередь; отставший отключается и переподключится.
+class MessageBroker:
+    def __init__(self, url, secret, peer_queue):
+        check_broker_secret(url, secret)
+        self.url = url
+        self.secret = secret.encode()
+        self.peer_queue = peer_queue
+        self._peers = {}
+        self.frames = 0
+        self.dropped_peers = 0
+    
+    def serve(self):
+        family, address = parse_broker_url(self.url)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+        listener = eventlet.listen(address, family)
+        while True:
+            conn, _ = listener.accept()
+            eventlet.spawn(self._handle, conn)
+    
+    def _handle(self, conn):
+        try:
+            if not hmac.compare_digest(recv_frame(conn), self.secret):
+                return
+            outbox = queue.Queue(self.peer_queue)
+            self._peers[conn] = outbox
+            eventlet.spawn(self._write, conn, outbox)
+            while True:
+                frame = recv_frame(conn)
+                self.frames += 1
+                for peer, peer_outbox in list(self._peers.items()):
+                    if peer is conn:
+                        continue
+                    try:
+                        peer_outbox.put_nowait(frame)
+                    except queue.Full:
+                        self.dropped_peers += 1
+                        self._drop(peer)
+        except OSError:
+            pass
+        finally:
+            self._drop(conn)
+    
+    def _write(self, conn, outbox):
+        try:
+            while conn in self._peers:
+                try:
+                    frame = outbox.get(timeout=1)
+                except queue.Empty:
+                    continue
+                send_frame(conn, frame)
+        except OSError:
+            self._drop(conn)
+    
+    def _drop(self, conn):
+        self._peers.pop(conn, None)
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+
+# Помимо событий Socket.IO по той же шине ходят служебные события кластера
+# (method='vox'): сброс кэша сессий, изменения членства, баны.
+class ClusterBusMixin:
+    def _listen(self):
+        for message in super()._listen():
+            data = message
+            if isinstance(message, bytes):
+                try:
+                    data = pickle.loads(message)
+                except Exception:
+                    data = json.loads(message)
+            if isinstance(data, dict) and data.get('method') == 'vox':
+                if data.get('host_id') != self.host_id:
+                    handle_cluster_event(data['action'], data['args'])
+                continue
+            yield data
+    
+    def publish_cluster(self, action, args):
+        self._publish({'method': 'vox', 'action': action, 'args': args, 'host_id': self.host_id})
+
+class BrokerManager(PubSubManager):
+    name = 'vox'
+    
+    def __init__(self, url, channel=MESSAGE_QUEUE_CHANNEL, write_only=False, logger=None):
+        check_broker_secret(url, BROKER_SECRET)
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.url = url
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+    
+    def _publish(self, data):
+        payload = json.dumps(data).encode()
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = connect_broker(self.url)
+                    send_frame(self._publisher, payload)
+                    return
+                except OSError:
+                    if self._publisher is not None:
+                        self._publisher.close()
+                        self._publisher = None
+                    if attempt:
+                        raise
+    
+    def _listen(self):
+        while True:
+            try:
+                sock = connect_broker(self.url)
+                while True:
+                    yield json.loads(recv_frame(sock))
+            except OSError:
+                self._get_logger().warning('Соединение с брокером %s потеряно, переподключение', self.url)
+                eventlet.sleep(1)
+
+class ClusterBrokerManager(ClusterBusMixin, BrokerManager):
+    pass
+
+class ClusterRedisManager(ClusterBusMixin, RedisManager):
+    pass
+
+class ClusterKombuManager(ClusterBusMixin, KombuManager):
+    pass
+
+def make_client_manager(url):
+    if url.startswith(('vox://', 'vox+unix://')):
+        return ClusterBrokerManager(url)
+    if url.startswith(('redis://', 'rediss://')):
+        return ClusterRedisManager(url, channel=MESSAGE_QUEUE_CHANNEL)
+    return ClusterKombuManager(url, channel=MESSAGE_QUEUE_CHANNEL)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = secrets.token_hex(32)
+# Отчёты фоновых задач идут через app.logger уровнем INFO - по умолчанию он бы их отбросил
+app.logger.setLevel(os.environ.get('VOX_LOG_LEVEL', 'INFO'))
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+if MESSAGE_QUEUE:
+    socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet',
+                        client_manager=make_client_manager(MESSAGE_QUEUE))
+else:
+    socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
 
 @app.route('/')
 def index():
     return jsonify({'status': 'Vox Server Running', 'version': '1.0'})
 
-DB_FILE = 'vox_database.db'
+# Метрики в формате Prometheus. Гистограммы с фиксированными корзинами: observe()
+# только увеличивает готовые счётчики, без блокировок (один хаб eventlet + GIL)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ('counts', 'total', 'count')
+    
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self):
+        self.http = {}
+        self.http_status = {}
+        self.events = {}
+        self.queries = {}
+        self._query_kinds = {}
+    
+    def _histogram(self, table, key):
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram()
+        return histogram
+    
+    def observe_request(self, route, method, status, elapsed):
+        self._histogram(self.http, (route, method)).observe(elapsed)
+        key = (route, method, status)
+        self.http_status[key] = self.http_status.get(key, 0) + 1
+    
+    def observe_event(self, event, elapsed):
+        self._histogram(self.events, event).observe(elapsed)
+    
+    def observe_query(self, sql, elapsed):
+        # Тексты запросов - в основном константы модуля, поэтому вид запроса кэшируется по строке
+        kind = self._query_kinds.get(sql)
+        if kind is None:
+            kind = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'OTHER'
+            if len(self._query_kinds) < 1000:
+                self._query_kinds[sql] = kind
+        self._histogram(self.queries, kind).observe(elapsed)
+
+metrics = Metrics()
+
+@app.before_request
+def start_request_timer():
+    request.environ['vox.started'] = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    started = request.environ.get('vox.started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - started)
+    return response
+
+def timed_event(event):
+    def decorator(handler):
+        def wrapper(*args):
+            started = time.perf_counter()
+            try:
+                return handler(*args)
+            finally:
+                metrics.observe_event(event, time.perf_counter() - started)
+        wrapper.__name__ = handler.__name__
+        return wrapper
+    return decorator
+
+BLOCKING_WORKERS = int(os.environ.get('VOX_BLOCKING_WORKERS', 16))
+KDF_WORKERS = int(os.environ.get('VOX_KDF_WORKERS', 4))
+
+# Потоки tpool создаются при первом вызове, поэтому размер задаётся до любого обращения к БД
+tpool.set_num_threads(int(os.environ.get('EVENTLET_THREADPOOL_SIZE', BLOCKING_WORKERS + KDF_WORKERS)))
+
+# Долгие блокирующие и CPU-ёмкие вызовы (KDF паролей, пачка писателя сообщений с fsync
+# коммита, запись архивов, хэширование файлов) уходят в потоки tpool, чтобы не останавливать
+# цикл eventlet. Короткие запросы выполняются прямо в гринлете: переход в поток и обратно
+# дороже их самих. Семафор ограничивает число одновременных вызовов, остальные гринлеты
+# ждут слота - глубина этой очереди и время ожидания видны в метриках.
+class BlockingExecutor:
+    # Настоящий (не зелёный) thread-local: вызов из рабочего потока выполняется на месте
+    _local = eventlet.patcher.original('threading').local()
+    
+    @classmethod
+    def in_worker(cls):
+        return getattr(cls._local, 'worker', False)
+    
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self._slots = eventlet.semaphore.Semaphore(workers)
+        self.queued = 0
+        self.active = 0
+        self.max_queued = 0
+        self.calls = 0
+        self.wait = Histogram()
+        self.run_time = Histogram()
+    
+    def run(self, fn, *args):
+        if self.in_worker():
+            return fn(*args)
+        queued_at = time.perf_counter()
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        with self._slots:
+            self.queued -= 1
+            self.active += 1
+            started = time.perf_counter()
+            self.wait.observe(started - queued_at)
+            try:
+                return tpool.execute(self._call, fn, args)
+            finally:
+                self.active -= 1
+                self.calls += 1
+                self.run_time.observe(time.perf_counter() - started)
+    
+    def _call(self, fn, args):
+        self._local.worker = True
+        try:
+            return fn(*args)
+        finally:
+            self._local.worker = False
+    
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queued': self.queued,
+            'active': self.active,
+            'max_queued': self.max_queued,
+            'calls': self.calls,
+            'avg_wait_ms': round(self.wait.total * 1000 / self.wait.count, 3) if self.wait.count else 0.0,
+            'avg_run_ms': round(self.run_time.total * 1000 / self.run_time.count, 3) if self.run_time.count else 0.0
+        }
+
+db_executor = BlockingExecutor('db', BLOCKING_WORKERS)
+kdf_executor = BlockingExecutor('kdf', KDF_WORKERS)
+executors = (db_executor, kdf_executor)
+
+# Метрики и профилировщик однопоточные: в рабочем потоке BlockingExecutor запросы не
+# записываются, время всего вызова записывает гринлет, отправивший его в поток
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            if not BlockingExecutor.in_worker():
+                elapsed = time.perf_counter() - started
+                metrics.observe_query(sql, elapsed)
+                if profiler.enabled:
+                    profiler.record(self, sql, parameters, elapsed)
+    
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            if not BlockingExecutor.in_worker():
+                elapsed = time.perf_counter() - started
+                metrics.observe_query(sql, elapsed)
+                if profiler.enabled:
+                    profiler.record(self, sql, None, elapsed)
+    
+    def fetchall(self):
+        if not profiler.enabled or BlockingExecutor.in_worker():
+            return super().fetchall()
+        started = time.perf_counter()
+        rows = super().fetchall()
+        profiler.record_fetch(self, time.perf_counter() - started)
+        return rows
+
+class InstrumentedConnection(sqlite3.Connection):
+    vox_archives = None
+    vox_profiled = False
+    vox_trace_sql = None
+    vox_steps = 0
+    
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+SQL_PROFILER_ENABLED = os.environ.get('VOX_SQL_PROFILER', '0') == '1'
+SLOW_QUERY_MS = float(os.environ.get('VOX_SLOW_QUERY_MS', 50))
+SQL_PROFILER_PROGRESS_STEPS = 1000
+SQL_PROFILER_MAX_STATEMENTS = 500
+SQL_PROFILER_SLOW_LOG = 100
+
+# Профилировщик SQL: агрегирует запросы по нормализованному тексту (вызовы, суммарное
+# и максимальное время, шаги VM sqlite). Трассировка sqlite3 даёт реальный текст с
+# подставленными значениями, progress handler считает шаги VM - большое число шагов
+# на вызов выдаёт полный скан. Запросы дольше порога пишутся в лог с EXPLAIN QUERY PLAN.
+class QueryProfiler:
+    def __init__(self, enabled, slow_threshold):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold
+        self.statements = {}
+        self.slow_log = deque(maxlen=SQL_PROFILER_SLOW_LOG)
+        self._normalized = {}
+    
+    def sync(self, conn):
+        if self.enabled:
+            conn.set_trace_callback(partial(self._on_trace, conn))
+            conn.set_progress_handler(partial(self._on_progress, conn), SQL_PROFILER_PROGRESS_STEPS)
+        else:
+            conn.set_trace_callback(None)
+            conn.set_progress_handler(None, 0)
+        conn.vox_profiled = self.enabled
+    
+    def _on_trace(self, conn, sql):
+        # Подзапросы триггеров приходят как "-- TRIGGER ..." и относятся к текущему запросу
+        if not sql.startswith('--'):
+            conn.vox_trace_sql = sql
+            conn.vox_steps = 0
+    
+    def _on_progress(self, conn):
+        conn.vox_steps += 1
+        return 0
+    
+    def _normalize(self, sql):
+        key = self._normalized.get(sql)
+        if key is None:
+            key = ' '.join(sql.split())
+            if len(self._normalized) < SQL_PROFILER_MAX_STATEMENTS * 4:
+                self._normalized[sql] = key
+        return key
+    
+    def record(self, cursor, sql, parameters, elapsed):
+        key = self._normalize(sql)
+        entry = self.statements.get(key)
+        if entry is None:
+            if len(self.statements) >= SQL_PROFILER_MAX_STATEMENTS:
+                key = '(прочие запросы)'
+                entry = self.statements.setdefault(key, [0, 0.0, 0.0, 0])
+            else:
+                entry = self.statements[key] = [0, 0.0, 0.0, 0]
+        steps = cursor.connection.vox_steps
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+        entry[3] += steps
+        cursor.vox_profile = [entry, sql, parameters, elapsed, steps, False]
+        self._check_slow(cursor)
+    
+    def record_fetch(self, cursor, elapsed):
+        profile = getattr(cursor, 'vox_profile', None)
+        if profile is None:
+            return
+        entry = profile[0]
+        steps = cursor.connection.vox_steps
+        profile[3] += elapsed
+        entry[1] += elapsed
+        entry[2] = max(entry[2], profile[3])
+        entry[3] += max(steps - profile[4], 0)
+        profile[4] = steps
+        self._check_slow(cursor)
+    
+    def _check_slow(self, cursor):
+        entry, sql, parameters, elapsed, steps, logged = cursor.vox_profile
+        if logged or elapsed * 1000 < self.slow_threshold:
+            return
+        cursor.vox_profile[5] = True
+        conn = cursor.connection
+        expanded = conn.vox_trace_sql
+        plan = self.explain(conn, sql, parameters)
+        self.slow_log.append({
+            'at': datetime.datetime.now().isoformat(),
+            'sql': self._normalize(sql),
+            'expanded': expanded[:1000] if expanded else None,
+            'elapsed_ms': round(elapsed * 1000, 3),
+            'vm_steps': steps * SQL_PROFILER_PROGRESS_STEPS,
+            'plan': plan
+        })
+        app.logger.warning('Медленный запрос %.1f мс: %s | план: %s', elapsed * 1000, self._normalize(sql), plan)
+    
+    def explain(self, conn, sql, parameters):
+        if parameters is None or not sql.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')):
+            return None
+        try:
+            # Базовый execute, чтобы EXPLAIN не попал в метрики и профиль
+            rows = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+        except sqlite3.Error as e:
+            return [f'EXPLAIN не удался: {e}']
+        return [row[3] for row in rows]
+    
+    def report(self, top, sort):
+        index = {'calls': 0, 'total': 1, 'max': 2}[sort]
+        ordered = sorted(self.statements.items(), key=lambda item: item[1][index], reverse=True)[:top]
+        return [{
+            'sql': sql,
+            'calls': calls,
+            'total_ms': round(total * 1000, 3),
+            'avg_ms': round(total * 1000 / calls, 3) if calls else 0.0,
+            'max_ms': round(longest * 1000, 3),
+            'avg_vm_steps': (steps * SQL_PROFILER_PROGRESS_STEPS) // calls if calls else 0
+        } for sql, (calls, total, longest, steps) in ordered]
+    
+    def reset(self):
+        self.statements.clear()
+        self.slow_log.clear()
+
+profiler = QueryProfiler(SQL_PROFILER_ENABLED, SLOW_QUERY_MS)
+
+DB_FILE = os.environ.get('VOX_DB_FILE', 'vox_database.db')
+DB_POOL_SIZE = int(os.environ.get('VOX_DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('VOX_DB_POOL_TIMEOUT', 10))
+DB_BUSY_TIMEOUT = float(os.environ.get('VOX_DB_BUSY_TIMEOUT', 5))
+DB_SYNCHRONOUS = os.environ.get('VOX_DB_SYNCHRONOUS', 'NORMAL')
+DB_CACHE_SIZE_KB = int(os.environ.get('VOX_DB_CACHE_SIZE_KB', 16384))
+DB_MMAP_SIZE = int(os.environ.get('VOX_DB_MMAP_SIZE', 256 * 1024 * 1024))
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    def __init__(self, path, size, timeout):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        # LIFO: чаще всего отдаём самое "тёплое" соединение с прогретым кэшем страниц
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+    
+    def _connect(self):
+        # check_same_thread=False: соединение может переходить между гринлетами
+        # uri=True: архивы подключаются через ATTACH 'file:...?mode=ro'
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                               factory=InstrumentedConnection, uri=True)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={DB_SYNCHRONOUS}')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+    
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self.created < self.size
+                if can_create:
+                    self.created += 1
+            if can_create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self.created -= 1
+                    raise
+            else:
+                # Пул исчерпан - ждём кооперативно (queue пропатчена eventlet)
+                started = time.perf_counter()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    self.timeouts += 1
+                    raise PoolTimeout(f'no free database connection in {self.timeout}s')
+                waited = time.perf_counter() - started
+                self.waits += 1
+                self.wait_time_total += waited
+                self.wait_time_max = max(self.wait_time_max, waited)
+        self.in_use += 1
+        self.acquired += 1
+        return conn
+    
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self.in_use -= 1
+        self._idle.put(conn)
+    
+    def stats(self):
+        return {
+            'size': self.size,
+            'created': self.created,
+            'in_use': self.in_use,
+            'idle': self._idle.qsize(),
+            'acquired': self.acquired,
+            'waits': self.waits,
+            'timeouts': self.timeouts,
+            'wait_time_total': round(self.wait_time_total, 6),
+            'wait_time_avg': round(self.wait_time_total / self.waits, 6) if self.waits else 0.0,
+            'wait_time_max': round(self.wait_time_max, 6)
+        }
+
+db_pool = ConnectionPool(DB_FILE, DB_POOL_SIZE, DB_POOL_TIMEOUT)
+
+@contextmanager
+def get_db():
+    conn = db_pool.acquire()
+    if conn.vox_profiled != profiler.enabled:
+        profiler.sync(conn)
+    try:
+        yield conn
+    finally:
+        db_pool.release(conn)
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    return jsonify({'success': False, 'error': 'Сервер перегружен, попробуйте позже'}), 503
+
+@app.route('/api/stats/db', methods=['GET'])
+def db_stats():
+    return jsonify({'success': True, 'pool': db_pool.stats()})
+
+# Миграции схемы: номер версии -> шаги (SQL или функция от соединения).
+# Применённая версия хранится в PRAGMA user_version, каждая миграция выполняется один раз.
+SEARCH_INDEXED = '''({row}.id > (SELECT until_id FROM search_backfill WHERE id = 1)
+                OR {row}.id <= (SELECT done_id FROM search_backfill WHERE id = 1))'''
+
+MIGRATIONS = [
+    (1, [
+        # Таблица пользователей
+        '''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            email TEXT,
+            status TEXT DEFAULT 'active',
+            role TEXT DEFAULT 'user',
+            verified INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_seen TIMESTAMP,
+            avatar TEXT,
+            bio TEXT
+        )''',
+
+        # Таблица сессий
+        '''CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            token TEXT UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''',
+
+        # Таблица чатов
+        '''CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            type TEXT DEFAULT 'private',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            avatar TEXT
+        )''',
+
+        # Таблица участников чатов
+        '''CREATE TABLE IF NOT EXISTS chat_members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            user_id INTEGER,
+            role TEXT DEFAULT 'member',
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''',
+
+        # Таблица сообщений
+        '''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            user_id INTEGER,
+            content TEXT,
+            type TEXT DEFAULT 'text',
+            file_path TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            edited INTEGER DEFAULT 0,
+            FOREIGN KEY (chat_id) REFERENCES chats(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''',
+
+        # Таблица блокировок
+        '''CREATE TABLE IF NOT EXISTS bans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            reason TEXT,
+            banned_by INTEGER,
+            banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (banned_by) REFERENCES users(id)
+        )''',
+
+        # Таблица обращений в поддержку
+        '''CREATE TABLE IF NOT EXISTS support_tickets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            subject TEXT,
+            message TEXT,
+            status TEXT DEFAULT 'open',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''',
+
+        # Таблица ботов
+        '''CREATE TABLE IF NOT EXISTS bots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE,
+            token TEXT UNIQUE,
+            owner_id INTEGER,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (owner_id) REFERENCES users(id)
+        )''',
+
+        # Таблица премиум подписок
+        '''CREATE TABLE IF NOT EXISTS premium (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            expires_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )'''
+    ]),
+    (2, [
+        # Индексы под горячие запросы: история чата, список чатов, проверка членства, баны
+        '''DELETE FROM chat_members WHERE id NOT IN (
+            SELECT MIN(id) FROM chat_members GROUP BY user_id, chat_id
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id, id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_members_user_chat ON chat_members (user_id, chat_id)',
+        'CREATE INDEX IF NOT EXISTS idx_chat_members_chat_user ON chat_members (chat_id, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_bans_user_banned_at ON bans (user_id, banned_at)'
+    ]),
+    (3, [
+        # Денормализация для списка чатов: последнее сообщение чата и позиция прочтения участника
+        'ALTER TABLE chats ADD COLUMN last_message_id INTEGER',
+        'ALTER TABLE chat_members ADD COLUMN last_read_message_id INTEGER DEFAULT 0',
+        'UPDATE chats SET last_message_id = (SELECT MAX(id) FROM messages WHERE chat_id = chats.id)',
+        # Существующую историю считаем прочитанной, чтобы не показать всем тысячи непрочитанных
+        '''UPDATE chat_members SET last_read_message_id = COALESCE(
+            (SELECT last_message_id FROM chats WHERE id = chat_members.chat_id), 0
+        )'''
+    ]),
+    (4, [
+        # Полнотекстовый поиск: FTS5 с внешним содержимым, текст хранится только в messages
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )''',
+        # Существующие сообщения до until_id индексирует фоновый backfill, done_id - его прогресс
+        '''CREATE TABLE IF NOT EXISTS search_backfill (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            done_id INTEGER NOT NULL,
+            until_id INTEGER NOT NULL
+        )''',
+        'INSERT OR IGNORE INTO search_backfill (id, done_id, until_id) SELECT 1, 0, COALESCE(MAX(id), 0) FROM messages',
+        # Триггеры трогают только уже проиндексированные строки: 'delete' для строки,
+        # которой нет в индексе, испортил бы external-content таблицу
+        f'''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+            WHEN {SEARCH_INDEXED.format(row='new')} BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+            WHEN {SEARCH_INDEXED.format(row='old')} BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages
+            WHEN {SEARCH_INDEXED.format(row='old')} BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END'''
+    ]),
+    (5, [
+        # Вложения: блобы адресуются SHA-256 содержимого, одна копия на диске на любой файл
+        '''CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mime TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        # Загрузки пользователей; blob_hash заполняется после завершения
+        '''CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            name TEXT,
+            mime TEXT,
+            size INTEGER NOT NULL,
+            blob_hash TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_uploads_user_blob ON uploads (user_id, blob_hash)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_file_path ON messages (file_path) WHERE file_path IS NOT NULL'
+    ]),
+    (6, [
+        # Аватары хранят хэш блоба; индексы для проверки доступа к картинке по хэшу
+        'CREATE INDEX IF NOT EXISTS idx_users_avatar ON users (avatar) WHERE avatar IS NOT NULL',
+        'CREATE INDEX IF NOT EXISTS idx_chats_avatar ON chats (avatar) WHERE avatar IS NOT NULL'
+    ]),
+    (7, [
+        # Версия списка чатов пользователя: растёт при изменении членства и метаданных чатов
+        'ALTER TABLE users ADD COLUMN chats_version INTEGER DEFAULT 0'
+    ]),
+    (8, [
+        # Срок жизни сессии (unix-время); существующие сессии получают 30 дней от момента миграции
+        'ALTER TABLE sessions ADD COLUMN expires_at INTEGER',
+        "UPDATE sessions SET expires_at = CAST(strftime('%s', 'now') AS INTEGER) + 2592000",
+        'CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id, expires_at)'
+    ]),
+    (9, [
+        # Карта холодного архива: какие id чата лежат в файле какого периода
+        '''CREATE TABLE IF NOT EXISTS archive_chunks (
+            chat_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, period)
+        )'''
+    ])
+]
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def apply_migrations(conn, target=None):
+    applied = []
+    for number, steps in MIGRATIONS:
+        if target is not None and number > target:
+            break
+        if number <= schema_version(conn):
+            continue
+        # BEGIN IMMEDIATE + повторная проверка версии: безопасно при старте нескольких процессов
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if number <= schema_version(conn):
+                conn.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(number)
+    return applied
 
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
-    # Таблица пользователей
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password_hash TEXT NOT NULL,
-        email TEXT,
-        status TEXT DEFAULT 'active',
-        role TEXT DEFAULT 'user',
-        verified INTEGER DEFAULT 0,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        last_seen TIMESTAMP,
-        avatar TEXT,
-        bio TEXT
-    )''')
-    
-    # Таблица сессий
-    c.execute('''CREATE TABLE IF NOT EXISTS sessions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        token TEXT UNIQUE,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )''')
-    
-    # Таблица чатов
-    c.execute('''CREATE TABLE IF NOT EXISTS chats (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        type TEXT DEFAULT 'private',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        avatar TEXT
-    )''')
-    
-    # Таблица участников чатов
-    c.execute('''CREATE TABLE IF NOT EXISTS chat_members (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        chat_id INTEGER,
-        user_id INTEGER,
-        role TEXT DEFAULT 'member',
-        joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (chat_id) REFERENCES chats(id),
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )''')
-    
-    # Таблица сообщений
-    c.execute('''CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        chat_id INTEGER,
-        user_id INTEGER,
-        content TEXT,
-        type TEXT DEFAULT 'text',
-        file_path TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        edited INTEGER DEFAULT 0,
-        FOREIGN KEY (chat_id) REFERENCES chats(id),
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )''')
-    
-    # Таблица блокировок
-    c.execute('''CREATE TABLE IF NOT EXISTS bans (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        reason TEXT,
-        banned_by INTEGER,
-        banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users(id),
-        FOREIGN KEY (banned_by) REFERENCES users(id)
-    )''')
-    
-    # Таблица обращений в поддержку
-    c.execute('''CREATE TABLE IF NOT EXISTS support_tickets (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        subject TEXT,
-        message TEXT,
-        status TEXT DEFAULT 'open',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )''')
-    
-    # Таблица ботов
-    c.execute('''CREATE TABLE IF NOT EXISTS bots (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT UNIQUE,
-        token TEXT UNIQUE,
-        owner_id INTEGER,
-        description TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (owner_id) REFERENCES users(id)
-    )''')
-    
-    # Таблица премиум подписок
-    c.execute('''CREATE TABLE IF NOT EXISTS premium (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        expires_at TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )''')
-    
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        for number in apply_migrations(conn):
+            print(f"Применена миграция схемы {number}")
+
+PASSWORD_SCRYPT_N = int(os.environ.get('VOX_SCRYPT_N', 2 ** 14))
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
 
+def scrypt_digest(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+# Формат: scrypt$n$r$p$соль$хэш. Старые хэши - несолёный sha256 в hex, они принимаются
+# при входе и сразу перехэшируются; так же обновляются хэши с устаревшими параметрами.
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    salt = secrets.token_bytes(16)
+    digest = kdf_executor.run(scrypt_digest, password, salt, PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    return f'scrypt${PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}${salt.hex()}${digest.hex()}'
+
+def verify_password(password, stored):
+    # -> (пароль верен, хэш нужно обновить)
+    if not stored.startswith('scrypt$'):
+        valid = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+        return valid, valid
+    try:
+        _, n, r, p, salt, expected = stored.split('$')
+        n, r, p = int(n), int(r), int(p)
+        digest = kdf_executor.run(scrypt_digest, password, bytes.fromhex(salt), n, r, p)
+    except ValueError:
+        return False, False
+    valid = hmac.compare_digest(digest.hex(), expected)
+    return valid, valid and (n, r, p) != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+
+# Для несуществующего логина KDF всё равно считается - по этому хэшу с текущими параметрами.
+# Ни один пароль с ним не совпадёт, а время ответа не выдаёт, есть ли такой пользователь.
+DUMMY_PASSWORD_HASH = f'scrypt${PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}${"00" * 16}$'
+
+SESSION_CACHE_SIZE = int(os.environ.get('VOX_SESSION_CACHE_SIZE', 50000))
+SESSION_CACHE_TTL = float(os.environ.get('VOX_SESSION_CACHE_TTL', 300))
+
+# Кэш token -> (user_id, username, role, verified, status): LRU с ограниченным размером и TTL.
+# Инвалидируется явно при выходе и блокировке, TTL страхует от прочих изменений в users.
+class SessionCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tokens_by_user = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def get(self, token):
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        user, expires_at = entry
+        if expires_at < time.monotonic():
+            self._remove(token)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return user
+    
+    def put(self, token, user, lifetime=None):
+        if token in self._entries:
+            self._remove(token)
+        # Запись не должна пережить саму сессию
+        ttl = self.ttl if lifetime is None else min(self.ttl, lifetime)
+        self._entries[token] = (user, time.monotonic() + ttl)
+        self._tokens_by_user.setdefault(user[0], set()).add(token)
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+    
+    def _remove(self, token):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[0][0]
+        tokens = self._tokens_by_user.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user_id]
+    
+    def invalidate(self, token):
+        if token in self._entries:
+            self._remove(token)
+            self.invalidations += 1
+    
+    def invalidate_user(self, user_id):
+        for token in list(self._tokens_by_user.get(user_id, ())):
+            self._remove(token)
+            self.invalidations += 1
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+SESSION_TTL = int(os.environ.get('VOX_SESSION_TTL', 30 * 24 * 3600))
+SESSION_RENEW_AFTER = int(os.environ.get('VOX_SESSION_RENEW_AFTER', 24 * 3600))
+SESSION_MAX_PER_USER = int(os.environ.get('VOX_SESSION_MAX_PER_USER', 10))
+SESSION_SWEEP_INTERVAL = float(os.environ.get('VOX_SESSION_SWEEP_INTERVAL', 60))
+SESSION_SWEEP_BATCH = int(os.environ.get('VOX_SESSION_SWEEP_BATCH', 500))
+SESSION_SWEEP_PAUSE = 0.05
+
+# Жизненный цикл сессий: срок expires_at со скользящим продлением, лимит сессий на
+# пользователя (лишние - с самым ранним сроком, т.е. дольше всех не использованные) и
+# фоновая очистка просроченных строк. Продления копятся в памяти и пишутся пачкой, как
+# отметки присутствия; очистка удаляет короткими транзакциями по sweep_batch строк.
+# Строки без expires_at (вставленные старым кодом) живут ttl от created_at.
+class SessionManager:
+    def __init__(self, ttl, renew_after, max_per_user, sweep_interval, sweep_batch, sweep_pause):
+        self.ttl = ttl
+        self.renew_after = renew_after
+        self.max_per_user = max_per_user
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self.sweep_pause = sweep_pause
+        self.sweeping = False
+        self._renewals = {}
+        self._thread = None
+        self.created = 0
+        self.renewed = 0
+        self.evicted = 0
+        self.sweeps = 0
+        self.reclaimed = 0
+        self.last_reclaimed = 0
+        self.sweep_time_total = 0.0
+    
+    def start(self, sweep=False):
+        # Продления пишет каждый процесс, очистку - только назначенный
+        self.sweeping = self.sweeping or sweep
+        if self._thread is None:
+            self._thread = socketio.start_background_task(self._run)
+    
+    def create(self, c, user_id):
+        # -> (token, вытесненные токены); вытесненные нужно инвалидировать после коммита
+        self.start()
+        token = secrets.token_hex(32)
+        c.execute("INSERT INTO sessions (user_id, token, expires_at) VALUES (?, ?, ?)",
+                  (user_id, token, int(time.time()) + self.ttl))
+        c.execute("""SELECT token FROM sessions WHERE user_id = ? 
+                     ORDER BY expires_at DESC, id DESC LIMIT -1 OFFSET ?""", (user_id, self.max_per_user))
+        evicted = [row[0] for row in c.fetchall()]
+        if evicted:
+            c.executemany("DELETE FROM sessions WHERE token = ?", [(token,) for token in evicted])
+            self.evicted += len(evicted)
+        self.created += 1
+        return token, evicted
+    
+    def touch(self, token, expires_at, now):
+        # -> актуальный срок; продлеваем не чаще раза в renew_after
+        self.start()
+        if expires_at - now > self.ttl - self.renew_after:
+            return expires_at
+        expires_at = self._renewals[token] = now + self.ttl
+        return expires_at
+    
+    def _run(self):
+        while True:
+            socketio.sleep(self.sweep_interval)
+            try:
+                self.flush()
+                if self.sweeping:
+                    self.sweep()
+            except Exception:
+                app.logger.exception('Ошибка обслуживания сессий')
+    
+    def flush(self):
+        if not self._renewals:
+            return 0
+        renewals, self._renewals = self._renewals, {}
+        try:
+            with get_db() as conn:
+                conn.executemany("UPDATE sessions SET expires_at = ? WHERE token = ?",
+                                 [(expires_at, token) for token, expires_at in renewals.items()])
+                conn.commit()
+        except Exception:
+            for token, expires_at in renewals.items():
+                self._renewals.setdefault(token, expires_at)
+            raise
+        self.renewed += len(renewals)
+        return len(renewals)
+    
+    def sweep(self):
+        started = time.perf_counter()
+        reclaimed = 0
+        while True:
+            now = int(time.time())
+            with get_db() as conn:
+                deleted = conn.execute("""DELETE FROM sessions WHERE id IN 
+                                          (SELECT id FROM sessions WHERE expires_at <= ? 
+                                               OR (expires_at IS NULL AND created_at <= datetime(?, 'unixepoch')) 
+                                           LIMIT ?)""",
+                                       (now, now - self.ttl, self.sweep_batch)).rowcount
+                conn.commit()
+            reclaimed += deleted
+            if deleted < self.sweep_batch:
+                break
+            socketio.sleep(self.sweep_pause)
+        self.sweeps += 1
+        self.last_reclaimed = reclaimed
+        self.reclaimed += reclaimed
+        self.sweep_time_total += time.perf_counter() - started
+        if reclaimed:
+            app.logger.info('Удалено просроченных сессий: %d', reclaimed)
+        return reclaimed
+    
+    def stats(self):
+        return {
+            'ttl': self.ttl,
+            'renew_after': self.renew_after,
+            'max_per_user': self.max_per_user,
+            'sweeping': self.sweeping,
+            'pending_renewals': len(self._renewals),
+            'created': self.created,
+            'renewed': self.renewed,
+            'evicted': self.evicted,
+            'sweeps': self.sweeps,
+            'reclaimed': self.reclaimed,
+            'last_reclaimed': self.last_reclaimed,
+            'sweep_time_total': round(self.sweep_time_total, 6)
+        }
+
+session_manager = SessionManager(SESSION_TTL, SESSION_RENEW_AFTER, SESSION_MAX_PER_USER,
+                                 SESSION_SWEEP_INTERVAL, SESSION_SWEEP_BATCH, SESSION_SWEEP_PAUSE)
+
+def resolve_session(c, token):
+    if not token:
+        return None
+    user = session_cache.get(token)
+    if user is not None:
+        return user
+    now = int(time.time())
+    c.execute("""SELECT u.id, u.username, u.role, u.verified, u.status, 
+                        COALESCE(s.expires_at, CAST(strftime('%s', s.created_at) AS INTEGER) + ?) 
+                 FROM sessions s JOIN users u ON s.user_id = u.id 
+                 WHERE s.token = ?""", (session_manager.ttl, token))
+    row = c.fetchone()
+    if not row or row[5] is None or row[5] <= now:
+        return None
+    user = row[:5]
+    expires_at = session_manager.touch(token, row[5], now)
+    session_cache.put(token, user, expires_at - now)
+    return user
+
+def ban_reason(c, user_id):
+    c.execute("SELECT reason FROM bans WHERE user_id = ? ORDER BY banned_at DESC LIMIT 1", (user_id,))
+    ban = c.fetchone()
+    return ban[0] if ban else 'Нарушение правил'
+
+@app.route('/api/stats/sessions', methods=['GET'])
+def session_stats():
+    return jsonify({'success': True, 'cache': session_cache.stats(), 'lifecycle': session_manager.stats()})
 
 def create_creator_user():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username = ?", ('maloy',))
-    if not c.fetchone():
-        password_hash = hash_password('admin123')
-        c.execute("""INSERT INTO users (username, password_hash, role, verified) 
-                     VALUES (?, ?, ?, ?)""", ('maloy', password_hash, 'creator', 1))
-        conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM users WHERE username = ?", ('maloy',))
+        if not c.fetchone():
+            password_hash = hash_password('admin123')
+            c.execute("""INSERT INTO users (username, password_hash, role, verified) 
+                         VALUES (?, ?, ?, ?)""", ('maloy', password_hash, 'creator', 1))
+            conn.commit()
+
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('VOX_PRESENCE_FLUSH_INTERVAL', 5))
+PRESENCE_ONLINE_WINDOW = float(os.environ.get('VOX_PRESENCE_ONLINE_WINDOW', 120))
+
+# Присутствие в памяти: touch() только обновляет словари, last_seen пишется в БД
+# одним executemany раз в flush_interval и при остановке сервера.
+# Онлайн - активность за последние online_window секунд.
+class PresenceTracker:
+    def __init__(self, flush_interval, online_window):
+        self.flush_interval = flush_interval
+        self.online_window = online_window
+        self._dirty = {}
+        self._active = {}
+        self._connections = {}
+        self._thread = None
+        self.touches = 0
+        self.flushes = 0
+        self.rows_flushed = 0
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = socketio.start_background_task(self._run)
+    
+    def touch(self, user_id):
+        self.start()
+        self.touches += 1
+        self._dirty[user_id] = datetime.datetime.now()
+        came_online = user_id not in self._active
+        self._active[user_id] = time.monotonic()
+        if came_online:
+            socketio.start_background_task(self._notify, user_id, True)
+    
+    def connected(self, user_id):
+        self._connections[user_id] = self._connections.get(user_id, 0) + 1
+        self.touch(user_id)
+    
+    def disconnected(self, user_id):
+        left = self._connections.get(user_id, 0) - 1
+        if left > 0:
+            self._connections[user_id] = left
+            return
+        self._connections.pop(user_id, None)
+        # Последний сокет закрыт - офлайн сразу, не дожидаясь окна активности
+        self._dirty[user_id] = datetime.datetime.now()
+        if self._active.pop(user_id, None) is not None:
+            socketio.start_background_task(self._notify, user_id, False)
+    
+    def _run(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            try:
+                self.expire()
+                self.flush()
+            except Exception:
+                app.logger.exception('Ошибка сброса присутствия')
+    
+    def expire(self):
+        cutoff = time.monotonic() - self.online_window
+        for user_id in [u for u, seen in self._active.items() if seen < cutoff and u not in self._connections]:
+            del self._active[user_id]
+            socketio.start_background_task(self._notify, user_id, False)
+    
+    def flush(self):
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, {}
+        try:
+            with get_db() as conn:
+                conn.executemany("UPDATE users SET last_seen = ? WHERE id = ?",
+                                 [(seen, user_id) for user_id, seen in dirty.items()])
+                conn.commit()
+        except Exception:
+            # Вернём несохранённое, не затирая более свежие отметки
+            for user_id, seen in dirty.items():
+                self._dirty.setdefault(user_id, seen)
+            raise
+        self.flushes += 1
+        self.rows_flushed += len(dirty)
+        return len(dirty)
+    
+    def _notify(self, user_id, online):
+        with get_db() as conn:
+            chat_ids = [row[0] for row in conn.execute("SELECT chat_id FROM chat_members WHERE user_id = ?", (user_id,))]
+        payload = {'user_id': user_id, 'online': online, 'last_seen': datetime.datetime.now().isoformat()}
+        for chat_id in chat_ids:
+            socketio.emit('presence', payload, room=chat_id)
+    
+    def stats(self):
+        return {
+            'online': len(self._active),
+            'connected': len(self._connections),
+            'pending': len(self._dirty),
+            'touches': self.touches,
+            'flushes': self.flushes,
+            'rows_flushed': self.rows_flushed,
+            'flush_interval': self.flush_interval
+        }
+
+presence = PresenceTracker(PRESENCE_FLUSH_INTERVAL, PRESENCE_ONLINE_WINDOW)
+
+@app.route('/api/stats/presence', methods=['GET'])
+def presence_stats():
+    return jsonify({'success': True, 'presence': presence.stats()})
+
+# Лимиты: имя -> (ёмкость корзины, пополнение в секунду). Переопределяются через
+# VOX_RATE_LIMITS="login=10:0.2,message=30:5"; ёмкость 0 отключает лимит.
+RATE_LIMITS = {
+    'login': (20, 20 / 60),
+    'login_user': (10, 10 / 300),
+    'register': (5, 5 / 3600),
+    'search': (30, 1),
+    'message': (30, 5)
+}
+RATE_LIMIT_COMPACT_INTERVAL = float(os.environ.get('VOX_RATE_LIMIT_COMPACT_INTERVAL', 60))
+# За прокси (Railway/Render) адрес клиента берётся из X-Forwarded-For, но только из
+# последних TRUSTED_PROXY_HOPS записей, которые дописали наши прокси: левые записи
+# присылает сам клиент. ProxyFix подставляет этот адрес в request.remote_addr.
+TRUSTED_PROXY_HOPS = int(os.environ.get('VOX_TRUSTED_PROXY_HOPS', 0))
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+def parse_rate_limits(value, defaults):
+    limits = dict(defaults)
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, spec = item.partition('=')
+        capacity, _, rate = spec.partition(':')
+        limits[name.strip()] = (float(capacity), float(rate))
+    return {name: limit for name, limit in limits.items() if limit[0] > 0 and limit[1] > 0}
+
+# Token bucket в памяти процесса. Корзина - [токены, время обновления] в словаре по
+# (лимит, ключ), проверка - один поиск и арифметика. Фоновая компактация удаляет корзины,
+# которые успели наполниться: полная корзина неотличима от отсутствующей. В кластере
+# лимит действует в каждом процессе отдельно.
+class RateLimiter:
+    def __init__(self, limits, compact_interval):
+        self.limits = limits
+        self.compact_interval = compact_interval
+        self._buckets = {}
+        self._thread = None
+        self.allowed = dict.fromkeys(limits, 0)
+        self.rejected = dict.fromkeys(limits, 0)
+        self.compactions = 0
+        self.compacted = 0
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = socketio.start_background_task(self._run)
+    
+    def hit(self, name, key):
+        # -> 0, если вызов разрешён, иначе сколько секунд ждать следующего токена
+        limit = self.limits.get(name)
+        if limit is None:
+            return 0
+        self.start()
+        capacity, rate = limit
+        now = time.monotonic()
+        bucket = self._buckets.get((name, key))
+        if bucket is None:
+            bucket = self._buckets[(name, key)] = [capacity, now]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            self.allowed[name] += 1
+            return 0
+        self.rejected[name] += 1
+        return (1 - bucket[0]) / rate
+    
+    def _run(self):
+        while True:
+            socketio.sleep(self.compact_interval)
+            try:
+                self.compact()
+            except Exception:
+                app.logger.exception('Ошибка компактации лимитов')
+    
+    def compact(self):
+        removed = 0
+        for index, (bucket_key, (tokens, updated)) in enumerate(list(self._buckets.items())):
+            if index and index % 10000 == 0:
+                socketio.sleep(0)
+            capacity, rate = self.limits[bucket_key[0]]
+            bucket = self._buckets.get(bucket_key)
+            # Корзину могли тронуть, пока мы уступали цикл - проверяем актуальное состояние
+            if bucket is not None and bucket[0] + (time.monotonic() - bucket[1]) * rate >= capacity:
+                del self._buckets[bucket_key]
+                removed += 1
+        self.compactions += 1
+        self.compacted += removed
+        return removed
+    
+    def stats(self):
+        return {
+            'limits': {name: {'capacity': capacity, 'per_second': rate} for name, (capacity, rate) in self.limits.items()},
+            'buckets': len(self._buckets),
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+            'compactions': self.compactions,
+            'compacted': self.compacted
+        }
+
+rate_limiter = RateLimiter(parse_rate_limits(os.environ.get('VOX_RATE_LIMITS', ''), RATE_LIMITS),
+                           RATE_LIMIT_COMPACT_INTERVAL)
+
+def too_many_requests(retry_after):
+    response = jsonify({'success': False, 'error': 'Слишком много запросов, попробуйте позже',
+                        'retry_after': round(retry_after, 3)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response
+
+@app.route('/api/stats/ratelimit', methods=['GET'])
+def rate_limit_stats():
+    return jsonify({'success': True, 'ratelimit': rate_limiter.stats()})
 
 @app.route('/api/register', methods=['POST'])
 def register():
     data = request.json
-    username = data.get('username', '').strip()
+    username = data.get('username', '')
     password = data.get('password', '')
+    if not isinstance(username, str) or not isinstance(password, str):
+        return jsonify({'success': False, 'error': 'Юзернейм и пароль должны быть строками'}), 400
+    username = username.strip()
     
     if len(username) < 4:
         return jsonify({'success': False, 'error': 'Юзернейм должен быть минимум 4 символа'}), 400
@@ -150,23 +1416,32 @@ def register():
     if len(password) < 6:
         return jsonify({'success': False, 'error': 'Пароль должен быть минимум 6 символов'}), 400
     
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    retry_after = rate_limiter.hit('register', request.remote_addr)
+    if retry_after:
+        return too_many_requests(retry_after)
     
-    c.execute("SELECT * FROM users WHERE username = ?", (username,))
-    if c.fetchone():
-        conn.close()
-        return jsonify({'success': False, 'error': 'Юзернейм уже занят'}), 400
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        c.execute("SELECT * FROM users WHERE username = ?", (username,))
+        if c.fetchone():
+            return jsonify({'success': False, 'error': 'Юзернейм уже занят'}), 400
     
+    # KDF считается без соединения из пула: иначе волна регистраций занимает весь пул
     password_hash = hash_password(password)
-    c.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
-    user_id = c.lastrowid
-    
-    token = secrets.token_hex(32)
-    c.execute("INSERT INTO sessions (user_id, token) VALUES (?, ?)", (user_id, token))
     
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        try:
+            c.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
+        except sqlite3.IntegrityError:
+            return jsonify({'success': False, 'error': 'Юзернейм уже занят'}), 400
+        user_id = c.lastrowid
+        
+        token, _ = session_manager.create(c, user_id)
+        
+        conn.commit()
     
     return jsonify({'success': True, 'token': token, 'username': username, 'user_id': user_id})
 
@@ -175,34 +1450,49 @@ def login():
     data = request.json
     username = data.get('username', '')
     password = data.get('password', '')
+    if not isinstance(username, str) or not isinstance(password, str):
+        return jsonify({'success': False, 'error': 'Неверный логин или пароль'}), 400
     
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    # Отсекаем до KDF и базы: по адресу - скрипты, по логину с адреса - подбор пароля к одному
+    # аккаунту. Ключ включает адрес, чтобы чужой подбор не блокировал вход самому владельцу
+    ip = request.remote_addr
+    retry_after = rate_limiter.hit('login', ip) or rate_limiter.hit('login_user', (username.lower(), ip))
+    if retry_after:
+        return too_many_requests(retry_after)
     
-    password_hash = hash_password(password)
-    c.execute("SELECT id, username, role, verified, status FROM users WHERE username = ? AND password_hash = ?", 
-              (username, password_hash))
-    user = c.fetchone()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, username, role, verified, status, password_hash FROM users WHERE username = ?", (username,))
+        user = c.fetchone()
     
     if not user:
-        conn.close()
+        verify_password(password, DUMMY_PASSWORD_HASH)
         return jsonify({'success': False, 'error': 'Неверный логин или пароль'}), 401
     
-    user_id, username, role, verified, status = user
-    
-    if status == 'banned':
-        c.execute("SELECT reason FROM bans WHERE user_id = ? ORDER BY banned_at DESC LIMIT 1", (user_id,))
-        ban = c.fetchone()
-        reason = ban[0] if ban else 'Нарушение правил'
-        conn.close()
-        return jsonify({'success': False, 'error': 'banned', 'reason': reason}), 403
+    user_id, username, role, verified, status, stored_hash = user
+    # Проверка пароля - тоже вне соединения из пула, как и при регистрации
+    valid, rehash = verify_password(password, stored_hash)
+    if not valid:
+        return jsonify({'success': False, 'error': 'Неверный логин или пароль'}), 401
+    new_hash = hash_password(password) if rehash else None
     
-    token = secrets.token_hex(32)
-    c.execute("INSERT INTO sessions (user_id, token) VALUES (?, ?)", (user_id, token))
-    c.execute("UPDATE users SET last_seen = ? WHERE id = ?", (datetime.datetime.now(), user_id))
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        if status == 'banned':
+            return jsonify({'success': False, 'error': 'banned', 'reason': ban_reason(c, user_id)}), 403
+        
+        if new_hash is not None:
+            c.execute("UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                      (new_hash, user_id, stored_hash))
+        
+        token, evicted = session_manager.create(c, user_id)
+        
+        conn.commit()
+    for old_token in evicted:
+        cluster_notify('invalidate_token', old_token)
     
-    conn.commit()
-    conn.close()
+    presence.touch(user_id)
     
     return jsonify({
         'success': True, 
@@ -218,30 +1508,19 @@ def auto_login():
     data = request.json
     token = data.get('token', '')
     
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
-    c.execute("""SELECT u.id, u.username, u.role, u.verified, u.status 
-                 FROM sessions s JOIN users u ON s.user_id = u.id 
-                 WHERE s.token = ?""", (token,))
-    user = c.fetchone()
-    
-    if not user:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Неверный токен'}), 401
-    
-    user_id, username, role, verified, status = user
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        user = resolve_session(c, token)
+        if not user:
+            return jsonify({'success': False, 'error': 'Неверный токен'}), 401
+        
+        user_id, username, role, verified, status = user
+        
+        if status == 'banned':
+            return jsonify({'success': False, 'error': 'banned', 'reason': ban_reason(c, user_id)}), 403
     
-    if status == 'banned':
-        c.execute("SELECT reason FROM bans WHERE user_id = ? ORDER BY banned_at DESC LIMIT 1", (user_id,))
-        ban = c.fetchone()
-        reason = ban[0] if ban else 'Нарушение правил'
-        conn.close()
-        return jsonify({'success': False, 'error': 'banned', 'reason': reason}), 403
-    
-    c.execute("UPDATE users SET last_seen = ? WHERE id = ?", (datetime.datetime.now(), user_id))
-    conn.commit()
-    conn.close()
+    presence.touch(user_id)
     
     return jsonify({
         'success': True,
@@ -256,11 +1535,11 @@ def logout():
     data = request.json
     token = data.get('token', '')
     
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM sessions WHERE token = ?", (token,))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM sessions WHERE token = ?", (token,))
+        conn.commit()
+    cluster_notify('invalidate_token', token)
     
     return jsonify({'success': True})
 
@@ -271,85 +1550,1913 @@ def create_support_ticket():
     subject = data.get('subject', '')
     message = data.get('message', '')
     
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
-    c.execute("SELECT user_id FROM sessions WHERE token = ?", (token,))
-    session = c.fetchone()
-    if not session:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Не авторизован'}), 401
-    
-    user_id = session[0]
-    c.execute("INSERT INTO support_tickets (user_id, subject, message) VALUES (?, ?, ?)",
-              (user_id, subject, message))
-    
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, token)
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        user_id = session[0]
+        c.execute("INSERT INTO support_tickets (user_id, subject, message) VALUES (?, ?, ?)",
+                  (user_id, subject, message))
+        
+        conn.commit()
     
     return jsonify({'success': True, 'message': 'Обращение отправлено'})
 
+UNREAD_COUNT_CAP = 999
+PREVIEW_LENGTH = 100
+CHATS_FORMAT_VERSION = 1
+
+def bump_user_version(c, user_id):
+    c.execute("UPDATE users SET chats_version = chats_version + 1 WHERE id = ?", (user_id,))
+
+def bump_chat_version(c, chat_id):
+    c.execute("""UPDATE users SET chats_version = chats_version + 1 
+                 WHERE id IN (SELECT user_id FROM chat_members WHERE chat_id = ?)""", (chat_id,))
+
+# ETag списка чатов без построения самого списка. Версия пользователя покрывает членство и
+# метаданные; id сообщений глобально растут, поэтому MAX(last_message_id) меняется с любым
+# новым сообщением в его чатах, а сумма позиций прочтения - с любым прочтением.
+def chats_etag(c, user_id):
+    c.execute("""SELECT u.chats_version, COUNT(cm.chat_id), MAX(ch.last_message_id), TOTAL(cm.last_read_message_id) 
+                 FROM users u 
+                 LEFT JOIN chat_members cm ON cm.user_id = u.id 
+                 LEFT JOIN chats ch ON ch.id = cm.chat_id 
+                 WHERE u.id = ?""", (user_id,))
+    version, count, last_id, read_total = c.fetchone()
+    return f'chats-{CHATS_FORMAT_VERSION}-{user_id}-{version or 0}-{count}-{last_id or 0}-{int(read_total)}'
+
+def not_modified(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
 @app.route('/api/chats', methods=['GET'])
 def get_chats():
     token = request.args.get('token', '')
     
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, token)
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        user_id = session[0]
+        etag = chats_etag(c, user_id)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        
+        # Один запрос на весь список: превью по chats.last_message_id, непрочитанные -
+        # диапазон по индексу messages(chat_id, id) от позиции прочтения, с потолком
+        c.execute("""SELECT c.id, c.name, c.type, c.avatar, 
+                            m.id, m.user_id, substr(m.content, 1, ?), m.type, m.created_at, 
+                            (SELECT COUNT(*) FROM (SELECT 1 FROM messages 
+                                                   WHERE chat_id = c.id AND id > cm.last_read_message_id 
+                                                   LIMIT ?)) 
+                     FROM chat_members cm 
+                     JOIN chats c ON c.id = cm.chat_id 
+                     LEFT JOIN messages m ON m.id = c.last_message_id 
+                     WHERE cm.user_id = ? 
+                     ORDER BY c.last_message_id IS NULL, c.last_message_id DESC""",
+                  (PREVIEW_LENGTH, UNREAD_COUNT_CAP, user_id))
+        chats = c.fetchall()
     
-    c.execute("SELECT user_id FROM sessions WHERE token = ?", (token,))
-    session = c.fetchone()
-    if not session:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+    chats_list = [{
+        'id': ch[0],
+        'name': ch[1],
+        'type': ch[2],
+        'avatar': ch[3],
+        'avatar_url': image_url(ch[3], 'thumb'),
+        'last_message': {'id': ch[4], 'user_id': ch[5], 'content': ch[6], 'type': ch[7], 'created_at': ch[8]} if ch[4] else None,
+        'unread': ch[9]
+    } for ch in chats]
+    response = jsonify({'success': True, 'chats': chats_list})
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/chats/<int:chat_id>/read', methods=['POST'])
+def mark_chat_read(chat_id):
+    data = request.json
+    token = data.get('token', '')
+    message_id = data.get('message_id')
+    
+    # Строка для SQLite больше любого числа: MIN() взял бы last_message_id и прочитал чат целиком
+    if message_id is not None and (not isinstance(message_id, int) or isinstance(message_id, bool)):
+        return jsonify({'success': False, 'error': 'Некорректный message_id'}), 400
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, token)
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        # Без message_id - всё прочитано; позиция прочтения только растёт
+        c.execute("""UPDATE chat_members SET last_read_message_id = MAX(COALESCE(last_read_message_id, 0), 
+                         COALESCE((SELECT MIN(COALESCE(?, last_message_id, 0), COALESCE(last_message_id, 0)) 
+                                   FROM chats WHERE id = ?), 0)) 
+                     WHERE chat_id = ? AND user_id = ?""",
+                  (message_id, chat_id, chat_id, session[0]))
+        if c.rowcount == 0:
+            return jsonify({'success': False, 'error': 'Нет доступа к чату'}), 403
+        conn.commit()
+    
+    return jsonify({'success': True})
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 200
+# Компактный формат истории: имена полей один раз, строки - массивами
+HISTORY_FIELDS = ['id', 'user_id', 'content', 'type', 'file_path', 'created_at', 'edited']
+MAX_MESSAGE_ID = 2 ** 63 - 1
+
+ARCHIVE_DIR = os.environ.get('VOX_ARCHIVE_DIR', 'archive')
+ARCHIVE_MAX_ATTACHED = int(os.environ.get('VOX_ARCHIVE_MAX_ATTACHED', 8))
+ARCHIVE_CACHE_SIZE_KB = int(os.environ.get('VOX_ARCHIVE_CACHE_SIZE_KB', 1024))
+RETENTION_INTERVAL = float(os.environ.get('VOX_RETENTION_INTERVAL', 3600))
+RETENTION_BATCH = int(os.environ.get('VOX_RETENTION_BATCH', 500))
+RETENTION_PAUSE = 0.05
+# hot_days - сколько дней сообщения живут в основной базе (0 - не архивировать),
+# history_days - глубина истории, доступная при чтении (0 - без ограничения)
+RETENTION_POLICIES = {
+    'free': {
+        'hot_days': int(os.environ.get('VOX_RETENTION_FREE_HOT_DAYS', 30)),
+        'history_days': int(os.environ.get('VOX_RETENTION_FREE_HISTORY_DAYS', 0))
+    },
+    'premium': {
+        'hot_days': int(os.environ.get('VOX_RETENTION_PREMIUM_HOT_DAYS', 180)),
+        'history_days': 0
+    }
+}
+ARCHIVE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER,
+    user_id INTEGER,
+    content TEXT,
+    type TEXT,
+    file_path TEXT,
+    created_at TIMESTAMP,
+    edited INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id, id);
+'''
+
+def chat_is_premium(c, chat_id):
+    c.execute("""SELECT 1 FROM chat_members cm JOIN premium p ON p.user_id = cm.user_id 
+                 WHERE cm.chat_id = ? AND p.expires_at > CURRENT_TIMESTAMP LIMIT 1""", (chat_id,))
+    return c.fetchone() is not None
+
+def utc_days_ago(days):
+    # Формат CURRENT_TIMESTAMP, чтобы сравнивать с created_at как строки
+    return (datetime.datetime.utcnow() - datetime.timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+# Многоуровневое хранение истории. Чат премиальный, если в нём есть участник с активной
+# подпиской. Сообщения старше hot_days своего уровня переносятся пачками в файлы архива
+# по месяцам (archive/messages_YYYY_MM.db), а archive_chunks в основной базе помнит
+# диапазоны id чата в каждом файле. При чтении истории нужные файлы подключаются к
+# соединению пула через ATTACH только для чтения (LRU до max_attached на соединение,
+# с маленьким кэшем страниц), поэтому объём и кэш основной базы не растут с историей.
+# Последнее сообщение чата (превью в списке) и сообщения с файлами (по ним проверяется
+# доступ к блобам) остаются в основной базе. Архив не индексируется поиском.
+class RetentionEngine:
+    def __init__(self, directory, policies, batch, interval, pause, max_attached, cache_size_kb):
+        self.directory = directory
+        self.policies = policies
+        self.batch = batch
+        self.interval = interval
+        self.pause = pause
+        self.max_attached = max_attached
+        self.cache_size_kb = cache_size_kb
+        self._thread = None
+        self.runs = 0
+        self.batches = 0
+        self.moved = 0
+        self.last_moved = 0
+        self.run_time_total = 0.0
+        self.attaches = 0
+        self.detaches = 0
+        self.archive_reads = 0
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = socketio.start_background_task(self._run)
+    
+    def path(self, period):
+        return os.path.join(self.directory, f'messages_{period}.db')
+    
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                app.logger.exception('Ошибка переноса сообщений в архив')
+            socketio.sleep(self.interval)
+    
+    def boundary_id(self, conn, cutoff):
+        # Первый id с created_at >= cutoff: id растут вместе со временем вставки,
+        # поэтому хватает двоичного поиска по первичному ключу без индекса по дате
+        lo, hi = conn.execute("SELECT MIN(id), MAX(id) FROM messages").fetchone()
+        if lo is None:
+            return 0
+        hi += 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            row = conn.execute("SELECT id, created_at FROM messages WHERE id >= ? ORDER BY id LIMIT 1", (mid,)).fetchone()
+            if row is None or row[1] >= cutoff:
+                hi = mid
+            else:
+                lo = row[0] + 1
+        return lo
+    
+    def run_once(self):
+        started = time.perf_counter()
+        with get_db() as conn:
+            boundaries = {tier: self.boundary_id(conn, utc_days_ago(policy['hot_days']))
+                          for tier, policy in self.policies.items() if policy['hot_days'] > 0}
+            if not boundaries:
+                return 0
+            premium_chats = {row[0] for row in conn.execute(
+                """SELECT DISTINCT cm.chat_id FROM premium p JOIN chat_members cm ON cm.user_id = p.user_id 
+                   WHERE p.expires_at > CURRENT_TIMESTAMP""")}
+            chats = conn.execute("SELECT id, last_message_id FROM chats WHERE last_message_id IS NOT NULL").fetchall()
+        moved = 0
+        for chat_id, last_message_id in chats:
+            boundary = boundaries.get('premium' if chat_id in premium_chats else 'free')
+            if boundary is None:
+                continue
+            upper_id = min(boundary, last_message_id)
+            after_id = 0
+            while True:
+                count, after_id = self.move_batch(chat_id, after_id, upper_id)
+                moved += count
+                if after_id is None:
+                    break
+                socketio.sleep(self.pause)
+        self.runs += 1
+        self.moved += moved
+        self.last_moved = moved
+        self.run_time_total += time.perf_counter() - started
+        if moved:
+            app.logger.info('Перенесено в архив сообщений: %d', moved)
+        return moved
+    
+    def move_batch(self, chat_id, after_id, upper_id):
+        # -> (перенесено, id для следующей пачки или None, если чат обработан)
+        with get_db() as conn:
+            rows = conn.execute("""SELECT id, chat_id, user_id, content, type, file_path, created_at, edited 
+                                   FROM messages WHERE chat_id = ? AND id > ? AND id < ? 
+                                   ORDER BY id LIMIT ?""", (chat_id, after_id, upper_id, self.batch)).fetchall()
+        if not rows:
+            return 0, None
+        next_id = rows[-1][0] if len(rows) == self.batch else None
+        periods = {}
+        for row in rows:
+            if row[5] is None:
+                periods.setdefault(row[6][:7].replace('-', '_'), []).append(row)
+        if not periods:
+            return 0, next_id
+        # Сначала архив, потом удаление: после сбоя между шагами пачка просто перепишется
+        # (INSERT OR REPLACE), а читатели не видят архив, пока нет записи в archive_chunks
+        for period, part in periods.items():
+            db_executor.run(self._write_archive, period, part)
+        with get_db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for period, part in periods.items():
+                    conn.executemany("DELETE FROM messages WHERE id = ?", [(row[0],) for row in part])
+                    conn.execute("""INSERT INTO archive_chunks (chat_id, period, min_id, max_id, message_count) 
+                                    VALUES (?, ?, ?, ?, ?) 
+                                    ON CONFLICT (chat_id, period) DO UPDATE SET 
+                                        min_id = MIN(min_id, excluded.min_id), 
+                                        max_id = MAX(max_id, excluded.max_id), 
+                                        message_count = message_count + excluded.message_count""",
+                                 (chat_id, period, part[0][0], part[-1][0], len(part)))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        self.batches += 1
+        return sum(len(part) for part in periods.values()), next_id
+    
+    def _write_archive(self, period, rows):
+        os.makedirs(self.directory, exist_ok=True)
+        archive = sqlite3.connect(self.path(period), timeout=DB_BUSY_TIMEOUT)
+        try:
+            archive.executescript(ARCHIVE_SCHEMA)
+            archive.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            archive.commit()
+        finally:
+            archive.close()
+    
+    def attach(self, conn, period):
+        attached = conn.vox_archives
+        if attached is None:
+            attached = conn.vox_archives = OrderedDict()
+        schema = f'archive_{period}'
+        if period in attached:
+            attached.move_to_end(period)
+            return schema
+        while len(attached) >= self.max_attached:
+            old_period, _ = attached.popitem(last=False)
+            conn.execute(f'DETACH DATABASE archive_{old_period}')
+            self.detaches += 1
+        uri = 'file:' + urllib.parse.quote(os.path.abspath(self.path(period))) + '?mode=ro'
+        conn.execute(f'ATTACH DATABASE ? AS {schema}', (uri,))
+        conn.execute(f'PRAGMA {schema}.cache_size=-{self.cache_size_kb}')
+        attached[period] = True
+        self.attaches += 1
+        return schema
+    
+    def extend_history(self, conn, chat_id, rows, bound, limit, descending):
+        # rows - страница из основной базы (limit + 1 строк в порядке выдачи), дополняется
+        # строками архива, которые могут в неё попасть; bound - before_id/after_id запроса
+        chunks = conn.execute(f"""SELECT period, min_id, max_id FROM archive_chunks WHERE chat_id = ? 
+                                  ORDER BY min_id {'DESC' if descending else 'ASC'}""", (chat_id,)).fetchall()
+        if not chunks:
+            return rows
+        horizon = None
+        history_days = self.policies['free']['history_days']
+        if history_days > 0 and not chat_is_premium(conn.cursor(), chat_id):
+            horizon = utc_days_ago(history_days)
+        for period, min_id, max_id in chunks:
+            full = len(rows) > limit
+            if descending:
+                if min_id >= bound:
+                    continue
+                if full and max_id < rows[limit][0]:
+                    break
+            else:
+                if max_id <= bound:
+                    continue
+                if full and min_id > rows[limit][0]:
+                    break
+            if horizon is not None and period < horizon[:7].replace('-', '_'):
+                continue
+            schema = self.attach(conn, period)
+            archived = conn.execute(f"""SELECT id, user_id, content, type, file_path, created_at, edited 
+                                       FROM {schema}.messages WHERE chat_id = ? AND id {'<' if descending else '>'} ? 
+                                       AND created_at >= ? 
+                                       ORDER BY id {'DESC' if descending else 'ASC'} LIMIT ?""",
+                                    (chat_id, bound, horizon or '', limit + 1)).fetchall()
+            self.archive_reads += 1
+            rows = sorted(rows + archived, key=lambda row: row[0], reverse=descending)[:limit + 1]
+        return rows
+    
+    def stats(self):
+        try:
+            archives = sorted(name for name in os.listdir(self.directory) if name.endswith('.db'))
+        except FileNotFoundError:
+            archives = []
+        return {
+            'policies': self.policies,
+            'archives': len(archives),
+            'archive_bytes': sum(os.path.getsize(os.path.join(self.directory, name)) for name in archives),
+            'runs': self.runs,
+            'batches': self.batches,
+            'moved': self.moved,
+            'last_moved': self.last_moved,
+            'run_time_total': round(self.run_time_total, 6),
+            'attaches': self.attaches,
+            'detaches': self.detaches,
+            'archive_reads': self.archive_reads
+        }
+
+retention = RetentionEngine(ARCHIVE_DIR, RETENTION_POLICIES, RETENTION_BATCH, RETENTION_INTERVAL, RETENTION_PAUSE,
+                            ARCHIVE_MAX_ATTACHED, ARCHIVE_CACHE_SIZE_KB)
+
+@app.route('/api/stats/retention', methods=['GET'])
+def retention_stats():
+    return jsonify({'success': True, 'retention': retention.stats()})
+
+@app.route('/api/chats/<int:chat_id>/messages', methods=['GET'])
+def get_chat_messages(chat_id):
+    token = request.args.get('token', '')
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_PAGE_MAX)
+    
+    if before_id is not None and after_id is not None:
+        return jsonify({'success': False, 'error': 'Укажите только before_id или after_id'}), 400
+    # before_id=0 - явный курсор (пустая страница), а не «с конца»
+    upper_id = MAX_MESSAGE_ID if before_id is None else before_id
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, token)
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        c.execute("SELECT 1 FROM chat_members WHERE chat_id = ? AND user_id = ?", (chat_id, session[0]))
+        if not c.fetchone():
+            return jsonify({'success': False, 'error': 'Нет доступа к чату'}), 403
+        
+        # Keyset-пагинация по индексу messages(chat_id, id): стоимость страницы не зависит от глубины
+        if after_id is not None:
+            c.execute("""SELECT id, user_id, content, type, file_path, created_at, edited 
+                         FROM messages WHERE chat_id = ? AND id > ? 
+                         ORDER BY id LIMIT ?""", (chat_id, after_id, limit + 1))
+        else:
+            c.execute("""SELECT id, user_id, content, type, file_path, created_at, edited 
+                         FROM messages WHERE chat_id = ? AND id < ? 
+                         ORDER BY id DESC LIMIT ?""", (chat_id, upper_id, limit + 1))
+        rows = c.fetchall()
+        # Старая часть истории может лежать в архиве - дополняем страницу оттуда
+        if after_id is not None:
+            rows = retention.extend_history(conn, chat_id, rows, after_id, limit, False)
+        else:
+            rows = retention.extend_history(conn, chat_id, rows, upper_id, limit, True)
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is None:
+        rows.reverse()
+    
+    return jsonify({'success': True, 'fields': HISTORY_FIELDS, 'messages': rows, 'has_more': has_more})
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+SEARCH_MAX_TERMS = 8
+SEARCH_BACKFILL_CHUNK = int(os.environ.get('VOX_SEARCH_BACKFILL_CHUNK', 2000))
+SEARCH_BACKFILL_PAUSE = float(os.environ.get('VOX_SEARCH_BACKFILL_PAUSE', 0.05))
+SEARCH_FIELDS = ['id', 'chat_id', 'user_id', 'snippet', 'created_at']
+
+# Фоновая индексация сообщений, существовавших до миграции 4. Каждая порция - отдельная
+# короткая транзакция вместе с прогрессом, поэтому после перезапуска работа продолжается
+# с места остановки, а писатели ждут не дольше одной порции.
+class SearchBackfill:
+    def __init__(self, chunk_size, pause):
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self._thread = None
+        self.chunks = 0
+        self.rows = 0
+        self.done_id = None
+        self.until_id = None
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = socketio.start_background_task(self._run)
+    
+    def _run(self):
+        while True:
+            try:
+                if not self.run_chunk():
+                    break
+            except (sqlite3.OperationalError, PoolTimeout):
+                app.logger.exception('Порция индексации поиска не удалась, повтор')
+                socketio.sleep(self.pause * 20)
+            socketio.sleep(self.pause)
+        if self.rows:
+            app.logger.info('Индекс поиска заполнен: %d сообщений', self.rows)
+    
+    def run_chunk(self):
+        with get_db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.done_id, self.until_id = conn.execute(
+                    "SELECT done_id, until_id FROM search_backfill WHERE id = 1").fetchone()
+                if self.done_id >= self.until_id:
+                    conn.rollback()
+                    return False
+                last_id = conn.execute("""SELECT MAX(id) FROM (SELECT id FROM messages WHERE id > ? AND id <= ? 
+                                          ORDER BY id LIMIT ?)""",
+                                       (self.done_id, self.until_id, self.chunk_size)).fetchone()[0]
+                if last_id is None:
+                    last_id = self.until_id
+                cursor = conn.execute("""INSERT INTO messages_fts (rowid, content) 
+                                         SELECT id, content FROM messages WHERE id > ? AND id <= ?""",
+                                      (self.done_id, last_id))
+                conn.execute("UPDATE search_backfill SET done_id = ? WHERE id = 1", (last_id,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        self.chunks += 1
+        self.rows += cursor.rowcount
+        self.done_id = last_id
+        return True
+    
+    def stats(self):
+        return {
+            'running': self._thread is not None and self.done_id != self.until_id,
+            'done_id': self.done_id,
+            'until_id': self.until_id,
+            'chunks': self.chunks,
+            'rows': self.rows,
+            'chunk_size': self.chunk_size
+        }
+
+search_backfill = SearchBackfill(SEARCH_BACKFILL_CHUNK, SEARCH_BACKFILL_PAUSE)
+
+@app.route('/api/stats/search', methods=['GET'])
+def search_stats():
+    return jsonify({'success': True, 'backfill': search_backfill.stats()})
+
+# Каждое слово запроса - фраза в кавычках, чтобы синтаксис FTS5 из ввода не интерпретировался;
+# последнее слово ищется по префиксу, чтобы находить результаты по мере набора
+def build_match_query(text):
+    terms = [term.replace('"', '""') for term in text.split()[:SEARCH_MAX_TERMS]]
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"' for term in terms) + '*'
+
+@app.route('/api/search', methods=['GET'])
+def search_messages():
+    token = request.args.get('token', '')
+    match = build_match_query(request.args.get('q', ''))
+    chat_id = request.args.get('chat_id', type=int)
+    after_rank = request.args.get('after_rank', type=float)
+    after_id = request.args.get('after_id', type=int)
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), SEARCH_PAGE_MAX)
+    
+    if match is None:
+        return jsonify({'success': False, 'error': 'Пустой запрос'}), 400
+    if (after_rank is None) != (after_id is None):
+        return jsonify({'success': False, 'error': 'Укажите after_rank и after_id вместе'}), 400
+    
+    retry_after = rate_limiter.hit('search', token or request.remote_addr)
+    if retry_after:
+        return too_many_requests(retry_after)
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, token)
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        # Область поиска - только чаты пользователя; keyset-курсор по (ранг, id)
+        conditions = ['messages_fts MATCH ?']
+        params = [session[0], match]
+        if chat_id is not None:
+            conditions.append('m.chat_id = ?')
+            params.append(chat_id)
+        if after_id is not None:
+            conditions.append('(bm25(messages_fts) > ? OR (bm25(messages_fts) = ? AND m.id > ?))')
+            params += [after_rank, after_rank, after_id]
+        params.append(limit + 1)
+        c.execute(f"""SELECT m.id, m.chat_id, m.user_id, snippet(messages_fts, 0, '[', ']', '…', 12), 
+                             m.created_at, bm25(messages_fts) 
+                      FROM messages_fts 
+                      JOIN messages m ON m.id = messages_fts.rowid 
+                      JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = ? 
+                      WHERE {' AND '.join(conditions)} 
+                      ORDER BY bm25(messages_fts), m.id LIMIT ?""", params)
+        rows = c.fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    cursor = {'after_rank': rows[-1][5], 'after_id': rows[-1][0]} if has_more else None
+    
+    return jsonify({
+        'success': True,
+        'fields': SEARCH_FIELDS,
+        'results': [row[:5] for row in rows],
+        'has_more': has_more,
+        'next': cursor
+    })
+
+UPLOAD_DIR = os.environ.get('VOX_UPLOAD_DIR', 'uploads')
+UPLOAD_CHUNK_MAX = int(os.environ.get('VOX_UPLOAD_CHUNK_MAX', 8 * 1024 * 1024))
+UPLOAD_MAX_SIZE = 2 * 1024 ** 3
+UPLOAD_MAX_SIZE_PREMIUM = 4 * 1024 ** 3
+UPLOAD_STALE_HOURS = 24
+UPLOAD_READ_SIZE = 64 * 1024
+FILE_CACHE_MAX_AGE = 365 * 24 * 3600
+# За nginx/Apache отдачу файла (sendfile, Range) делает прокси по заголовку X-Sendfile
+app.config['USE_X_SENDFILE'] = os.environ.get('VOX_X_SENDFILE', '0') == '1'
+
+def is_premium(c, user_id):
+    c.execute("SELECT 1 FROM premium WHERE user_id = ? AND expires_at > CURRENT_TIMESTAMP LIMIT 1", (user_id,))
+    return c.fetchone() is not None
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+# Хранилище вложений. Чанки пишутся потоком прямо в parts/<upload_id>.part, размер файла -
+# и есть принятое смещение, поэтому после обрыва клиент продолжает с него. SHA-256 считается
+# на лету; если чанки попали в другой процесс или сервер перезапускался, хэш досчитывается
+# при завершении в пуле потоков. Готовый файл переносится в blobs/ab/cd/<hash>.
+class UploadStore:
+    def __init__(self, root, stale_hours):
+        self.root = root
+        self.stale_hours = stale_hours
+        self._hashers = {}
+        self._writing = set()
+        self._thread = None
+        self.chunks = 0
+        self.bytes_received = 0
+        self.completed = 0
+        self.deduplicated = 0
+        self.rehashed = 0
+        self.purged = 0
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = socketio.start_background_task(self._run)
+    
+    def part_path(self, upload_id):
+        return os.path.join(self.root, 'parts', upload_id + '.part')
+    
+    def blob_path(self, digest):
+        return os.path.join(self.root, 'blobs', digest[:2], digest[2:4], digest)
+    
+    def create(self, upload_id):
+        self.start()
+        path = self.part_path(upload_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+        self._hashers[upload_id] = (hashlib.sha256(), 0)
+    
+    def received(self, upload_id):
+        try:
+            return os.path.getsize(self.part_path(upload_id))
+        except FileNotFoundError:
+            return None
+    
+    def write_chunk(self, upload_id, offset, stream, length):
+        if upload_id in self._writing:
+            return None
+        self._writing.add(upload_id)
+        hasher, hashed = self._hashers.pop(upload_id, (None, None))
+        if hashed != offset:
+            hasher = None
+        written = 0
+        try:
+            with open(self.part_path(upload_id), 'ab') as f:
+                while written < length:
+                    block = stream.read(min(UPLOAD_READ_SIZE, length - written))
+                    if not block:
+                        break
+                    f.write(block)
+                    if hasher is not None:
+                        hasher.update(block)
+                    written += len(block)
+        finally:
+            self._writing.discard(upload_id)
+            self.bytes_received += written
+            # Хэш остаётся валидным, только если на диске ровно то, что через него прошло
+            if hasher is not None and self.received(upload_id) == offset + written:
+                self._hashers[upload_id] = (hasher, offset + written)
+        self.chunks += 1
+        return offset + written
+    
+    def finish(self, upload_id, size):
+        # -> (хэш, дубликат) или None, если по загрузке уже идёт запись чанка или завершение
+        if upload_id in self._writing:
+            return None
+        self._writing.add(upload_id)
+        try:
+            path = self.part_path(upload_id)
+            hasher, hashed = self._hashers.pop(upload_id, (None, None))
+            if hasher is None or hashed != size:
+                self.rehashed += 1
+                digest = db_executor.run(file_sha256, path)
+            else:
+                digest = hasher.hexdigest()
+            blob = self.blob_path(digest)
+            self.completed += 1
+            if os.path.exists(blob):
+                os.remove(path)
+                self.deduplicated += 1
+                return digest, True
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(path, blob)
+            return digest, False
+        finally:
+            self._writing.discard(upload_id)
+    
+    def _run(self):
+        while True:
+            try:
+                self.purge_stale()
+            except Exception:
+                app.logger.exception('Ошибка очистки незавершённых загрузок')
+            socketio.sleep(3600)
+    
+    def purge_stale(self):
+        with get_db() as conn:
+            rows = conn.execute("""SELECT id FROM uploads WHERE blob_hash IS NULL 
+                                   AND created_at < datetime('now', ?)""",
+                                (f'-{self.stale_hours} hours',)).fetchall()
+            cutoff = time.time() - self.stale_hours * 3600
+            stale = []
+            for (upload_id,) in rows:
+                try:
+                    # Долгая загрузка, которая ещё идёт, не удаляется
+                    if os.path.getmtime(self.part_path(upload_id)) > cutoff:
+                        continue
+                except FileNotFoundError:
+                    pass
+                stale.append(upload_id)
+            conn.executemany("DELETE FROM uploads WHERE id = ?", [(upload_id,) for upload_id in stale])
+            conn.commit()
+        for upload_id in stale:
+            self._hashers.pop(upload_id, None)
+            try:
+                os.remove(self.part_path(upload_id))
+            except FileNotFoundError:
+                pass
+        self.purged += len(stale)
+        return len(stale)
+    
+    def stats(self):
+        return {
+            'in_progress': len(self._hashers),
+            'writing': len(self._writing),
+            'chunks': self.chunks,
+            'bytes_received': self.bytes_received,
+            'completed': self.completed,
+            'deduplicated': self.deduplicated,
+            'rehashed': self.rehashed,
+            'purged': self.purged
+        }
+
+upload_store = UploadStore(UPLOAD_DIR, UPLOAD_STALE_HOURS)
+
+@app.route('/api/stats/uploads', methods=['GET'])
+def upload_stats():
+    return jsonify({'success': True, 'uploads': upload_store.stats()})
+
+def load_upload(c, upload_id, user_id):
+    c.execute("SELECT size, mime, blob_hash FROM uploads WHERE id = ? AND user_id = ?", (upload_id, user_id))
+    return c.fetchone()
+
+def upload_status(upload_id, size, blob_hash, received):
+    return {
+        'success': True,
+        'upload_id': upload_id,
+        'size': size,
+        'received': size if blob_hash else received,
+        'complete': blob_hash is not None,
+        'hash': blob_hash
+    }
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    data = request.json
+    token = data.get('token', '')
+    size = data.get('size')
+    
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        return jsonify({'success': False, 'error': 'Некорректный размер файла'}), 400
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, token)
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        limit = UPLOAD_MAX_SIZE_PREMIUM if is_premium(c, session[0]) else UPLOAD_MAX_SIZE
+        if size > limit:
+            return jsonify({'success': False, 'error': 'Файл слишком большой', 'max_size': limit}), 413
+        
+        upload_id = secrets.token_urlsafe(16)
+        upload_store.create(upload_id)
+        c.execute("INSERT INTO uploads (id, user_id, name, mime, size) VALUES (?, ?, ?, ?, ?)",
+                  (upload_id, session[0], str(data.get('name') or '')[:255],
+                   str(data.get('mime') or 'application/octet-stream')[:100], size))
+        conn.commit()
+    
+    result = upload_status(upload_id, size, None, 0)
+    result['chunk_size'] = UPLOAD_CHUNK_MAX
+    return jsonify(result)
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, request.args.get('token', ''))
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        upload = load_upload(c, upload_id, session[0])
+        if not upload:
+            return jsonify({'success': False, 'error': 'Загрузка не найдена'}), 404
     
-    user_id = session[0]
+    return jsonify(upload_status(upload_id, upload[0], upload[2], upload_store.received(upload_id)))
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    offset = request.args.get('offset', type=int)
+    length = request.content_length
     
-    c.execute("""SELECT c.id, c.name, c.type, c.avatar 
-                 FROM chats c 
-                 JOIN chat_members cm ON c.id = cm.chat_id 
-                 WHERE cm.user_id = ?""", (user_id,))
-    chats = c.fetchall()
+    if length is None:
+        return jsonify({'success': False, 'error': 'Нужен Content-Length'}), 411
+    if length > UPLOAD_CHUNK_MAX:
+        return jsonify({'success': False, 'error': 'Слишком большой чанк', 'chunk_size': UPLOAD_CHUNK_MAX}), 413
     
-    conn.close()
+    # Соединение с БД не держим, пока читается тело чанка
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, request.args.get('token', ''))
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        upload = load_upload(c, upload_id, session[0])
+        if not upload:
+            return jsonify({'success': False, 'error': 'Загрузка не найдена'}), 404
     
-    chats_list = [{'id': ch[0], 'name': ch[1], 'type': ch[2], 'avatar': ch[3]} for ch in chats]
-    return jsonify({'success': True, 'chats': chats_list})
+    size, _, blob_hash = upload
+    received = upload_store.received(upload_id)
+    if blob_hash or received is None:
+        return jsonify({'success': False, 'error': 'Загрузка уже завершена'}), 409
+    if offset != received:
+        return jsonify({'success': False, 'error': 'Неверное смещение', 'received': received}), 409
+    if offset + length > size:
+        return jsonify({'success': False, 'error': 'Чанк выходит за размер файла'}), 400
+    
+    received = upload_store.write_chunk(upload_id, offset, request.stream, length)
+    if received is None:
+        return jsonify({'success': False, 'error': 'Чанк уже загружается'}), 409
+    
+    return jsonify(upload_status(upload_id, size, None, received))
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, request.json.get('token', ''))
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        upload = load_upload(c, upload_id, session[0])
+        if not upload:
+            return jsonify({'success': False, 'error': 'Загрузка не найдена'}), 404
+    
+    size, mime, blob_hash = upload
+    if blob_hash:
+        return jsonify(dict(upload_status(upload_id, size, blob_hash, size), url=f'/api/files/{blob_hash}'))
+    received = upload_store.received(upload_id)
+    if received != size:
+        return jsonify({'success': False, 'error': 'Файл загружен не полностью', 'received': received}), 409
+    
+    finished = upload_store.finish(upload_id, size)
+    if finished is None:
+        return jsonify({'success': False, 'error': 'Загрузка уже завершается'}), 409
+    digest, deduplicated = finished
+    with get_db() as conn:
+        conn.execute("INSERT OR IGNORE INTO blobs (hash, size, mime) VALUES (?, ?, ?)", (digest, size, mime))
+        conn.execute("UPDATE uploads SET blob_hash = ?, completed_at = CURRENT_TIMESTAMP WHERE id = ?",
+                     (digest, upload_id))
+        conn.commit()
+    
+    result = upload_status(upload_id, size, digest, size)
+    result.update(url=f'/api/files/{digest}', deduplicated=deduplicated)
+    return jsonify(result)
+
+def is_blob_hash(value):
+    return len(value) == 64 and all(ch in '0123456789abcdef' for ch in value)
+
+# Доступ к файлу: загрузил сам или файл есть в сообщении чата, где пользователь состоит
+def load_blob(c, digest, user_id):
+    c.execute("""SELECT b.size, b.mime FROM blobs b WHERE b.hash = ? AND (
+                     EXISTS (SELECT 1 FROM uploads WHERE user_id = ? AND blob_hash = b.hash) 
+                     OR EXISTS (SELECT 1 FROM messages m 
+                                JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = ? 
+                                WHERE m.file_path = b.hash))""", (digest, user_id, user_id))
+    return c.fetchone()
+
+@app.route('/api/files/<digest>', methods=['GET'])
+def download_file(digest):
+    if not is_blob_hash(digest):
+        return jsonify({'success': False, 'error': 'Файл не найден'}), 404
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, request.args.get('token', ''))
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        blob = load_blob(c, digest, session[0])
+        if not blob:
+            return jsonify({'success': False, 'error': 'Файл не найден'}), 404
+    
+    mime = blob[1] or 'application/octet-stream'
+    # Range/If-Range и 206 обрабатывает werkzeug; содержимое по хэшу неизменно - ETag и есть хэш
+    response = send_file(os.path.abspath(upload_store.blob_path(digest)), mimetype=mime,
+                         as_attachment=not mime.startswith('image/'),
+                         download_name=request.args.get('name') or digest,
+                         conditional=True, etag=digest, max_age=FILE_CACHE_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+IMAGE_VARIANTS = {
+    # имя: (сторона в px, обрезать до квадрата)
+    'thumb': (96, True),
+    'preview': (320, False),
+    'large': (1280, False)
+}
+IMAGE_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg')
+}
+IMAGE_QUALITY = 80
+IMAGE_PIPELINE_VERSION = 1
+IMAGE_WORKERS = int(os.environ.get('VOX_IMAGE_WORKERS', min(os.cpu_count() or 1, 4)))
+
+def image_url(digest, variant):
+    return f'/api/images/{digest}/{variant}' if digest and is_blob_hash(digest) else None
+
+# Выполняется в дочернем процессе пула: декодирование и ресайз не блокируют event loop
+def render_image_variant(source, target, size, crop, image_format):
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        if crop:
+            image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        else:
+            image.thumbnail((size, size), Image.LANCZOS)
+        if image_format == 'JPEG':
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        temp = f'{target}.{os.getpid()}.tmp'
+        image.save(temp, image_format, quality=IMAGE_QUALITY)
+    os.replace(temp, target)
+    return os.path.getsize(target)
+
+# Варианты картинок кэшируются на диске рядом с блобами: variants/ab/<hash>.<вариант>.v<N>.<формат>.
+# Блоб неизменен, поэтому готовый вариант не инвалидируется; смена параметров - новая версия.
+# Одновременные запросы одного варианта ждут одну задачу пула.
+class ImagePipeline:
+    def __init__(self, store, workers):
+        self.store = store
+        self.workers = workers
+        self._pool = None
+        self._pending = {}
+        self.hits = 0
+        self.rendered = 0
+        self.failed = 0
+        self.bytes_rendered = 0
+        self.render_time_total = 0.0
+    
+    def variant_path(self, digest, variant, image_format):
+        return os.path.join(self.store.root, 'variants', digest[:2],
+                            f'{digest}.{variant}.v{IMAGE_PIPELINE_VERSION}.{image_format}')
+    
+    def get(self, digest, variant, image_format):
+        path = self.variant_path(digest, variant, image_format)
+        if os.path.exists(path):
+            self.hits += 1
+            return path
+        waiter = self._pending.get(path)
+        if waiter is not None:
+            waiter.wait()
+            return path
+        # Регистрируемся до первого переключения гринлетов, чтобы задача не запустилась дважды
+        done = self._pending[path] = eventlet.event.Event()
+        started = time.perf_counter()
+        try:
+            if self._pool is None:
+                # Пул создаётся лениво в процессе, который отдаёт картинки, а не в мастере/брокере
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            size, crop = IMAGE_VARIANTS[variant]
+            future = self._pool.submit(render_image_variant, self.store.blob_path(digest), path,
+                                       size, crop, IMAGE_FORMATS[image_format][0])
+            self.bytes_rendered += future.result()
+            self.rendered += 1
+        except Exception as e:
+            self.failed += 1
+            done.send_exception(e)
+            raise
+        else:
+            done.send(path)
+        finally:
+            del self._pending[path]
+            self.render_time_total += time.perf_counter() - started
+        return path
+    
+    def close(self):
+        # Ждём процессы пула: без join живые дочерние процессы не дают воркеру выйти по SIGTERM
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+    
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'pending': len(self._pending),
+            'hits': self.hits,
+            'rendered': self.rendered,
+            'failed': self.failed,
+            'bytes_rendered': self.bytes_rendered,
+            'render_time_total': round(self.render_time_total, 6)
+        }
+
+image_pipeline = ImagePipeline(upload_store, IMAGE_WORKERS)
+
+@app.route('/api/stats/images', methods=['GET'])
+def image_stats():
+    return jsonify({'success': True, 'images': image_pipeline.stats()})
+
+def is_avatar(c, digest):
+    c.execute("""SELECT 1 FROM users WHERE avatar = ? 
+                 UNION ALL SELECT 1 FROM chats WHERE avatar = ? LIMIT 1""", (digest, digest))
+    return c.fetchone() is not None
+
+@app.route('/api/images/<digest>/<variant>', methods=['GET'])
+def get_image(digest, variant):
+    image_format = request.args.get('format', 'webp')
+    if not is_blob_hash(digest) or variant not in IMAGE_VARIANTS:
+        return jsonify({'success': False, 'error': 'Картинка не найдена'}), 404
+    if image_format not in IMAGE_FORMATS:
+        return jsonify({'success': False, 'error': 'Неизвестный формат'}), 400
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, request.args.get('token', ''))
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        # Аватары видны всем авторизованным, остальные картинки - по правилам вложений
+        if not is_avatar(c, digest) and not load_blob(c, digest, session[0]):
+            return jsonify({'success': False, 'error': 'Картинка не найдена'}), 404
+    
+    etag = f'{digest}.{variant}.v{IMAGE_PIPELINE_VERSION}.{image_format}'
+    if request.if_none_match.contains(etag):
+        return '', 304, {'ETag': f'"{etag}"'}
+    
+    try:
+        path = image_pipeline.get(digest, variant, image_format)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return jsonify({'success': False, 'error': 'Файл не является картинкой'}), 415
+    
+    response = send_file(os.path.abspath(path), mimetype=IMAGE_FORMATS[image_format][1],
+                         conditional=True, etag=etag, max_age=FILE_CACHE_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+def owned_blob_mime(c, user_id, digest):
+    c.execute("""SELECT b.mime FROM uploads u JOIN blobs b ON b.hash = u.blob_hash 
+                 WHERE u.user_id = ? AND u.blob_hash = ? LIMIT 1""", (user_id, digest))
+    row = c.fetchone()
+    return (row[0] or '') if row else None
+
+@app.route('/api/profile/avatar', methods=['POST'])
+def set_profile_avatar():
+    data = request.json
+    digest = data.get('file')
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, data.get('token', ''))
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        if digest is not None:
+            mime = owned_blob_mime(c, session[0], digest)
+            if mime is None or not mime.startswith('image/'):
+                return jsonify({'success': False, 'error': 'Картинка не найдена'}), 404
+        c.execute("UPDATE users SET avatar = ? WHERE id = ?", (digest, session[0]))
+        conn.commit()
+    
+    return jsonify({'success': True, 'avatar': digest, 'avatar_url': image_url(digest, 'thumb')})
+
+@app.route('/api/chats/<int:chat_id>/avatar', methods=['POST'])
+def set_chat_avatar(chat_id):
+    data = request.json
+    digest = data.get('file')
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, data.get('token', ''))
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        c.execute("SELECT role FROM chat_members WHERE chat_id = ? AND user_id = ?", (chat_id, session[0]))
+        member = c.fetchone()
+        if not member or member[0] not in ('owner', 'admin'):
+            return jsonify({'success': False, 'error': 'Недостаточно прав'}), 403
+        
+        if digest is not None:
+            mime = owned_blob_mime(c, session[0], digest)
+            if mime is None or not mime.startswith('image/'):
+                return jsonify({'success': False, 'error': 'Картинка не найдена'}), 404
+        c.execute("UPDATE chats SET avatar = ? WHERE id = ?", (digest, chat_id))
+        bump_chat_version(c, chat_id)
+        conn.commit()
+    
+    avatar_url = image_url(digest, 'thumb')
+    socketio.emit('chat_updated', {'chat_id': chat_id, 'avatar': digest, 'avatar_url': avatar_url}, room=chat_id)
+    return jsonify({'success': True, 'avatar': digest, 'avatar_url': avatar_url})
+
+# От старшей роли к младшей: модерировать можно только тех, кто ниже по списку
+MODERATOR_ROLES = ('creator', 'admin', 'moderator')
+
+def outranks(role, target_role):
+    if target_role not in MODERATOR_ROLES:
+        return True
+    return MODERATOR_ROLES.index(role) < MODERATOR_ROLES.index(target_role)
+
+def set_user_banned(c, user_id, banned, reason=None, banned_by=None):
+    if banned:
+        c.execute("INSERT INTO bans (user_id, reason, banned_by) VALUES (?, ?, ?)",
+                  (user_id, reason, banned_by))
+    c.execute("UPDATE users SET status = ? WHERE id = ?", ('banned' if banned else 'active', user_id))
+
+def moderate_user(data, banned):
+    token = data.get('token', '')
+    target_id = data.get('user_id')
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        moderator = resolve_session(c, token)
+        if not moderator or moderator[2] not in MODERATOR_ROLES:
+            return jsonify({'success': False, 'error': 'Недостаточно прав'}), 403
+        
+        c.execute("SELECT role FROM users WHERE id = ?", (target_id,))
+        target = c.fetchone()
+        if not target:
+            return jsonify({'success': False, 'error': 'Пользователь не найден'}), 404
+        if not outranks(moderator[2], target[0]):
+            return jsonify({'success': False, 'error': 'Недостаточно прав'}), 403
+        
+        set_user_banned(c, target_id, banned, data.get('reason') or 'Нарушение правил', moderator[0])
+        conn.commit()
+    # Сессии пользователя больше не должны отдаваться из кэша со старым статусом
+    cluster_notify('user_moderated', target_id, banned)
+    
+    return jsonify({'success': True})
+
+@app.route('/api/admin/ban', methods=['POST'])
+def ban_user():
+    return moderate_user(request.json, True)
+
+@app.route('/api/admin/unban', methods=['POST'])
+def unban_user():
+    return moderate_user(request.json, False)
+
+ADMIN_ROLES = ('creator', 'admin')
+PROFILER_SORT_KEYS = ('total', 'max', 'calls')
+
+def require_admin(token):
+    with get_db() as conn:
+        user = resolve_session(conn.cursor(), token)
+    return user is not None and user[2] in ADMIN_ROLES
+
+# Внутренняя статистика (/api/stats/*: сессии, лимиты, пул, загрузки...) - только для
+# администраторов, как и профилировщик. Проверка одна на все маршруты, включая будущие
+@app.before_request
+def protect_stats():
+    if request.path.startswith('/api/stats/') and not require_admin(request.args.get('token', '')):
+        return jsonify({'success': False, 'error': 'Недостаточно прав'}), 403
+
+@app.route('/api/admin/profiler', methods=['GET'])
+def profiler_report():
+    if not require_admin(request.args.get('token', '')):
+        return jsonify({'success': False, 'error': 'Недостаточно прав'}), 403
+    
+    sort = request.args.get('sort', 'total')
+    if sort not in PROFILER_SORT_KEYS:
+        return jsonify({'success': False, 'error': 'Неизвестная сортировка'}), 400
+    top = min(max(request.args.get('top', 20, type=int), 1), 200)
+    
+    return jsonify({
+        'success': True,
+        'enabled': profiler.enabled,
+        'slow_threshold_ms': profiler.slow_threshold,
+        'worker': os.environ.get('VOX_WORKER_ID'),
+        'statements': profiler.report(top, sort),
+        'slow': list(profiler.slow_log)
+    })
+
+@app.route('/api/admin/profiler', methods=['POST'])
+def profiler_control():
+    data = request.json
+    if not require_admin(data.get('token', '')):
+        return jsonify({'success': False, 'error': 'Недостаточно прав'}), 403
+    
+    # Соединения пула переключают трассировку при следующей выдаче из get_db
+    if 'enabled' in data:
+        profiler.enabled = bool(data['enabled'])
+    if data.get('slow_threshold_ms') is not None:
+        profiler.slow_threshold = float(data['slow_threshold_ms'])
+    if data.get('reset'):
+        profiler.reset()
+    
+    return jsonify({'success': True, 'enabled': profiler.enabled, 'slow_threshold_ms': profiler.slow_threshold})
+
+# Аутентифицированные сокеты: токен проверяется один раз при connect, дальше
+# user_id и множество доступных чатов берутся из памяти по sid
+class SocketSession:
+    __slots__ = ('user_id', 'chats')
+    
+    def __init__(self, user_id, chats):
+        self.user_id = user_id
+        self.chats = chats
+
+socket_sessions = {}
+user_sids = {}
+
+def load_user_chats(c, user_id):
+    c.execute("SELECT chat_id FROM chat_members WHERE user_id = ?", (user_id,))
+    return {row[0] for row in c.fetchall()}
+
+def membership_changed(chat_id, user_id, added):
+    for sid in user_sids.get(user_id, ()):
+        session = socket_sessions.get(sid)
+        if session is None:
+            continue
+        if added:
+            session.chats.add(chat_id)
+            socketio.server.enter_room(sid, chat_id, namespace='/')
+        else:
+            session.chats.discard(chat_id)
+            socketio.server.leave_room(sid, chat_id, namespace='/')
+
+def add_chat_member(c, chat_id, user_id, role='member'):
+    c.execute("""INSERT OR IGNORE INTO chat_members (chat_id, user_id, role, last_read_message_id) 
+                 VALUES (?, ?, ?, COALESCE((SELECT last_message_id FROM chats WHERE id = ?), 0))""",
+              (chat_id, user_id, role, chat_id))
+    if c.rowcount == 0:
+        return False
+    bump_user_version(c, user_id)
+    return True
+
+def remove_chat_member(c, chat_id, user_id):
+    c.execute("DELETE FROM chat_members WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+    if c.rowcount == 0:
+        return False
+    bump_user_version(c, user_id)
+    return True
+
+def session_chat_id(data):
+    # Только целое число: строки, bool и списки от клиента не приводим
+    if not isinstance(data, dict):
+        return None
+    chat_id = data.get('chat_id')
+    if not isinstance(chat_id, int) or isinstance(chat_id, bool):
+        return None
+    return chat_id
+
+@app.route('/api/chats/create', methods=['POST'])
+def create_chat():
+    data = request.json
+    token = data.get('token', '')
+    name = data.get('name') or ''
+    chat_type = data.get('type', 'private')
+    usernames = data.get('members', [])
+    
+    if chat_type not in ('private', 'group', 'channel'):
+        return jsonify({'success': False, 'error': 'Неизвестный тип чата'}), 400
+    if not isinstance(usernames, list) or not all(isinstance(username, str) for username in usernames):
+        return jsonify({'success': False, 'error': 'members должен быть списком юзернеймов'}), 400
+    if not isinstance(name, str):
+        return jsonify({'success': False, 'error': 'Некорректное название чата'}), 400
+    name = name.strip()
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, token)
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        owner_id = session[0]
+        member_ids = []
+        for username in usernames:
+            c.execute("SELECT id FROM users WHERE username = ?", (username,))
+            user = c.fetchone()
+            if not user:
+                return jsonify({'success': False, 'error': f'Пользователь {username} не найден'}), 404
+            if user[0] != owner_id:
+                member_ids.append(user[0])
+        
+        c.execute("INSERT INTO chats (name, type) VALUES (?, ?)", (name, chat_type))
+        chat_id = c.lastrowid
+        add_chat_member(c, chat_id, owner_id, 'owner')
+        for member_id in member_ids:
+            add_chat_member(c, chat_id, member_id)
+        conn.commit()
+    
+    for user_id in [owner_id] + member_ids:
+        cluster_notify('membership_changed', chat_id, user_id, True)
+    
+    return jsonify({'success': True, 'chat_id': chat_id})
+
+@app.route('/api/chats/<int:chat_id>/leave', methods=['POST'])
+def leave_chat(chat_id):
+    data = request.json
+    token = data.get('token', '')
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        session = resolve_session(c, token)
+        if not session:
+            return jsonify({'success': False, 'error': 'Не авторизован'}), 401
+        
+        if not remove_chat_member(c, chat_id, session[0]):
+            return jsonify({'success': False, 'error': 'Нет доступа к чату'}), 403
+        conn.commit()
+    
+    cluster_notify('membership_changed', chat_id, session[0], False)
+    
+    return jsonify({'success': True})
 
 @socketio.on('connect')
-def handle_connect():
-    print('Client connected')
+@timed_event('connect')
+def handle_connect(auth=None):
+    token = (auth or {}).get('token') or request.args.get('token', '')
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        user = resolve_session(c, token)
+        if not user or user[4] == 'banned':
+            return False
+        chats = load_user_chats(c, user[0])
+    
+    user_id = user[0]
+    socket_sessions[request.sid] = SocketSession(user_id, chats)
+    user_sids.setdefault(user_id, set()).add(request.sid)
+    # Сокет сразу входит в комнаты всех своих чатов: отдельный join от клиента не нужен
+    for chat_id in chats:
+        join_room(chat_id)
+    presence.connected(user_id)
+
+@socketio.on('disconnect')
+@timed_event('disconnect')
+def handle_disconnect():
+    fanout.forget(request.sid)
+    session = socket_sessions.pop(request.sid, None)
+    if session is None:
+        return
+    sids = user_sids.get(session.user_id)
+    if sids is not None:
+        sids.discard(request.sid)
+        if not sids:
+            del user_sids[session.user_id]
+    presence.disconnected(session.user_id)
 
 @socketio.on('join')
+@timed_event('join')
 def handle_join(data):
-    room = data['chat_id']
+    session = socket_sessions.get(request.sid)
+    room = session_chat_id(data)
+    if session is None or room not in session.chats:
+        emit('error', {'error': 'Нет доступа к чату'})
+        return
     join_room(room)
     emit('status', {'msg': 'Joined chat'}, room=room)
 
-@socketio.on('message')
-def handle_message(data):
-    chat_id = data['chat_id']
-    user_id = data['user_id']
-    content = data['content']
-    
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("INSERT INTO messages (chat_id, user_id, content) VALUES (?, ?, ?)",
-              (chat_id, user_id, content))
-    message_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    
-    emit('new_message', {
+MESSAGE_BATCH_SIZE = int(os.environ.get('VOX_MESSAGE_BATCH_SIZE', 256))
+MESSAGE_BATCH_LATENCY_MS = float(os.environ.get('VOX_MESSAGE_BATCH_LATENCY_MS', 5))
+MESSAGE_INSERT_SQL = "INSERT INTO messages (chat_id, user_id, content, type, file_path) VALUES (?, ?, ?, ?, ?)"
+
+# Групповая запись сообщений: один гринлет-писатель собирает сообщения из очереди
+# и коммитит их одной транзакцией - по достижении max_batch или через max_latency
+# после первого сообщения пачки. После коммита on_commit получает реальный id строки.
+class MessageWriter:
+    def __init__(self, on_commit, max_batch, max_latency):
+        self.on_commit = on_commit
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._thread = None
+        self.batches = 0
+        self.messages = 0
+        self.failed = 0
+        self.largest_batch = 0
+        self.commit_time_total = 0.0
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = socketio.start_background_task(self._run)
+    
+    def submit(self, chat_id, user_id, content, context=None, attachment=None):
+        self.start()
+        self._queue.put((chat_id, user_id, content, context, attachment))
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(batch)
+    
+    def _write(self, batch):
+        started = time.perf_counter()
+        try:
+            with get_db() as conn:
+                # Вся пачка с коммитом - один вызов в потоке, а не переключение на каждый INSERT
+                ids, errors = db_executor.run(self._insert, conn, batch)
+            metrics.observe_query(MESSAGE_INSERT_SQL, time.perf_counter() - started)
+        except Exception:
+            app.logger.exception('Не удалось записать пачку из %d сообщений', len(batch))
+            self.failed += len(batch)
+            ids = [None] * len(batch)
+        else:
+            for error in errors:
+                app.logger.warning('Сообщение отклонено при записи: %s', error)
+            self.batches += 1
+            self.messages += len(batch) - len(errors)
+            self.failed += len(errors)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.commit_time_total += time.perf_counter() - started
+        for item, message_id in zip(batch, ids):
+            try:
+                self.on_commit(item, message_id)
+            except Exception:
+                app.logger.exception('Ошибка доставки сообщения')
+    
+    def _insert(self, conn, batch):
+        c = conn.cursor()
+        ids = []
+        errors = []
+        last_ids = {}
+        read_ids = {}
+        if not conn.in_transaction:
+            c.execute('BEGIN IMMEDIATE')
+        for chat_id, user_id, content, _, attachment in batch:
+            kind, file_path = attachment or ('text', None)
+            # Каждая строка под своей точкой сохранения: ошибочная строка откатывается одна,
+            # остальная пачка коммитится. Ошибки блокировки и ввода-вывода валят всю пачку
+            c.execute('SAVEPOINT message')
+            try:
+                c.execute(MESSAGE_INSERT_SQL, (chat_id, user_id, content, kind, file_path))
+            except sqlite3.OperationalError:
+                raise
+            except sqlite3.Error as e:
+                c.execute('ROLLBACK TO message')
+                c.execute('RELEASE message')
+                ids.append(None)
+                errors.append(f'chat {chat_id}, user {user_id}: {e}')
+                continue
+            c.execute('RELEASE message')
+            ids.append(c.lastrowid)
+            last_ids[chat_id] = c.lastrowid
+            read_ids[(chat_id, user_id)] = c.lastrowid
+        # Денормализованные поля обновляем раз на чат за пачку, а не на каждое сообщение
+        c.executemany("UPDATE chats SET last_message_id = ? WHERE id = ?",
+                      [(message_id, chat_id) for chat_id, message_id in last_ids.items()])
+        c.executemany("""UPDATE chat_members SET last_read_message_id = ? 
+                         WHERE chat_id = ? AND user_id = ?""",
+                      [(message_id, chat_id, user_id) for (chat_id, user_id), message_id in read_ids.items()])
+        conn.commit()
+        return ids, errors
+    
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'max_batch': self.max_batch,
+            'max_latency_ms': self.max_latency * 1000,
+            'batches': self.batches,
+            'messages': self.messages,
+            'failed': self.failed,
+            'largest_batch': self.largest_batch,
+            'avg_batch': round(self.messages / self.batches, 2) if self.batches else 0.0,
+            'commit_time_total': round(self.commit_time_total, 6)
+        }
+
+FANOUT_CHUNK_SIZE = int(os.environ.get('VOX_FANOUT_CHUNK_SIZE', 500))
+FANOUT_QUEUE_LIMIT = int(os.environ.get('VOX_FANOUT_QUEUE_LIMIT', 256))
+FANOUT_DROP_LIMIT = int(os.environ.get('VOX_FANOUT_DROP_LIMIT', 4096))
+FANOUT_RESYNC_INTERVAL = 1.0
+
+# Рассылка сообщений в комнаты чатов. Пакет кодируется один раз, в очередь каждого сокета
+# кладётся один и тот же объект. Комната до chunk_size получателей обслуживается сразу,
+# большая - отдельным гринлетом порциями по chunk_size с уступкой циклу между порциями;
+# пока он работает, новые сообщения комнаты встают в её очередь, порядок сохраняется.
+# Исходящая очередь сокета ограничена queue_limit: медленному получателю сообщения не
+# кладутся, а когда очередь разгрузится, он получает одно событие resync со списком чатов
+# для догрузки по истории. Сокет с очередью больше drop_limit отключается.
+class FanoutEngine:
+    def __init__(self, chunk_size, queue_limit, drop_limit, resync_interval):
+        self.chunk_size = chunk_size
+        self.queue_limit = queue_limit
+        self.drop_limit = drop_limit
+        self.resync_interval = resync_interval
+        self._rooms = {}
+        self._lagging = {}
+        self._dropping = set()
+        self._thread = None
+        self.messages = 0
+        self.deliveries = 0
+        self.chunks = 0
+        self.skipped = 0
+        self.resyncs = 0
+        self.dropped = 0
+        self.largest_room = 0
+        self.latency = Histogram()
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = socketio.start_background_task(self._run)
+    
+    def packet(self, event, data):
+        encoded = socketio.server.packet_class(socketio_packet.EVENT, namespace='/', data=[event, data]).encode()
+        return engineio_packet.Packet(engineio_packet.MESSAGE, encoded)
+    
+    def emit(self, event, data, room):
+        self.start()
+        job = (self.packet(event, data), time.perf_counter())
+        pending = self._rooms.get(room)
+        if pending is not None:
+            pending.append(job)
+            return
+        manager = socketio.server.manager
+        size = len(manager.rooms.get('/', {}).get(room, ()))
+        if size <= self.chunk_size:
+            self._deliver(manager.get_participants('/', room), job[0], room)
+            self._observe(job[1], size)
+            return
+        self._rooms[room] = deque([job])
+        socketio.start_background_task(self._drain, room)
+    
+    def _drain(self, room):
+        pending = self._rooms[room]
+        try:
+            while pending:
+                pkt, started = pending.popleft()
+                # get_participants копирует словарь комнаты (снимок на момент сообщения: вошедшие
+                # позже его не получат), а пары (sid, eio_sid) из копии берём порциями по chunk_size
+                participants = socketio.server.manager.get_participants('/', room)
+                recipients = 0
+                while True:
+                    chunk = list(islice(participants, self.chunk_size))
+                    if not chunk:
+                        break
+                    self._deliver(chunk, pkt, room)
+                    recipients += len(chunk)
+                    socketio.sleep(0)
+                self._observe(started, recipients)
+        except Exception:
+            app.logger.exception('Ошибка рассылки в комнату %s', room)
+        finally:
+            del self._rooms[room]
+    
+    def _deliver(self, participants, pkt, room):
+        sockets = socketio.server.eio.sockets
+        self.chunks += 1
+        for sid, eio_sid in participants:
+            sock = sockets.get(eio_sid)
+            if sock is None or sock.closed:
+                continue
+            lagging = self._lagging.get(sid)
+            depth = sock.queue.qsize()
+            if lagging is None and depth < self.queue_limit:
+                sock.send(pkt)
+                self.deliveries += 1
+                continue
+            self.skipped += 1
+            if lagging is None:
+                lagging = self._lagging[sid] = (eio_sid, set())
+            lagging[1].add(room)
+            if depth >= self.drop_limit and sid not in self._dropping:
+                self._dropping.add(sid)
+                socketio.start_background_task(self._drop, sid, eio_sid)
+    
+    def _drop(self, sid, eio_sid):
+        try:
+            socketio.server.eio.disconnect(eio_sid)
+            self.dropped += 1
+        finally:
+            self._dropping.discard(sid)
+            self._lagging.pop(sid, None)
+    
+    def _observe(self, started, recipients):
+        self.messages += 1
+        self.largest_room = max(self.largest_room, recipients)
+        self.latency.observe(time.perf_counter() - started)
+    
+    def forget(self, sid):
+        self._lagging.pop(sid, None)
+    
+    def _run(self):
+        while True:
+            socketio.sleep(self.resync_interval)
+            try:
+                self.flush_resyncs()
+            except Exception:
+                app.logger.exception('Ошибка отправки resync')
+    
+    def flush_resyncs(self):
+        sockets = socketio.server.eio.sockets
+        for sid, (eio_sid, rooms) in list(self._lagging.items()):
+            sock = sockets.get(eio_sid)
+            if sock is None or sock.closed:
+                del self._lagging[sid]
+            elif sock.queue.qsize() <= self.queue_limit // 4:
+                del self._lagging[sid]
+                sock.send(self.packet('resync', {'chat_ids': sorted(rooms)}))
+                self.resyncs += 1
+    
+    def stats(self):
+        return {
+            'chunk_size': self.chunk_size,
+            'queue_limit': self.queue_limit,
+            'drop_limit': self.drop_limit,
+            'messages': self.messages,
+            'deliveries': self.deliveries,
+            'chunks': self.chunks,
+            'largest_room': self.largest_room,
+            'rooms_in_progress': len(self._rooms),
+            'lagging': len(self._lagging),
+            'skipped': self.skipped,
+            'resyncs': self.resyncs,
+            'dropped': self.dropped,
+            'avg_latency_ms': round(self.latency.total * 1000 / self.latency.count, 3) if self.latency.count else 0.0
+        }
+
+fanout = FanoutEngine(FANOUT_CHUNK_SIZE, FANOUT_QUEUE_LIMIT, FANOUT_DROP_LIMIT, FANOUT_RESYNC_INTERVAL)
+
+@app.route('/api/stats/fanout', methods=['GET'])
+def fanout_stats():
+    return jsonify({'success': True, 'fanout': fanout.stats()})
+
+def deliver_message(item, message_id):
+    chat_id, user_id, content, sid, attachment = item
+    if message_id is None:
+        socketio.emit('error', {'error': 'Не удалось отправить сообщение'}, to=sid)
+        return
+    kind, file_path = attachment or ('text', None)
+    # Каждый процесс кластера рассылает своим сокетам сам
+    cluster_notify('fanout', 'new_message', {
         'id': message_id,
         'chat_id': chat_id,
         'user_id': user_id,
         'content': content,
+        'type': kind,
+        'file_path': file_path,
         'timestamp': datetime.datetime.now().isoformat()
-    }, room=chat_id)
+    }, chat_id)
+
+message_writer = MessageWriter(deliver_message, MESSAGE_BATCH_SIZE, MESSAGE_BATCH_LATENCY_MS / 1000)
+
+@app.route('/api/stats/executor', methods=['GET'])
+def executor_stats():
+    return jsonify({'success': True, 'executors': {executor.name: executor.stats() for executor in executors}})
+
+@app.route('/api/stats/messages', methods=['GET'])
+def message_stats():
+    return jsonify({'success': True, 'writer': message_writer.stats()})
+
+MAX_MESSAGE_LENGTH = 4096
+
+@socketio.on('message')
+@timed_event('message')
+def handle_message(data):
+    session = socket_sessions.get(request.sid)
+    chat_id = session_chat_id(data)
+    if session is None or chat_id not in session.chats:
+        emit('error', {'error': 'Нет доступа к чату'})
+        return
+    user_id = session.user_id
+    retry_after = rate_limiter.hit('message', user_id)
+    if retry_after:
+        emit('error', {'error': 'Слишком много сообщений', 'code': 429, 'retry_after': round(retry_after, 3)})
+        return
+    content = data.get('content', '')
+    digest = data.get('file')
+    # Проверяем до очереди писателя: неверная строка не должна доходить до пачки
+    if not isinstance(content, str) or (digest is not None and not isinstance(digest, str)):
+        emit('error', {'error': 'Неверный формат сообщения'})
+        return
+    if len(content) > MAX_MESSAGE_LENGTH:
+        emit('error', {'error': f'Сообщение длиннее {MAX_MESSAGE_LENGTH} символов'})
+        return
+    
+    attachment = None
+    if digest:
+        # Прикрепить можно только файл, который пользователь сам загрузил
+        with get_db() as conn:
+            mime = owned_blob_mime(conn.cursor(), user_id, digest)
+        if mime is None:
+            emit('error', {'error': 'Файл не найден'})
+            return
+        attachment = ('image' if mime.startswith('image/') else 'file', digest)
+    elif not content.strip():
+        emit('error', {'error': 'Пустое сообщение'})
+        return
+    
+    message_writer.submit(chat_id, user_id, content, request.sid, attachment)
+    presence.touch(user_id)
+
+def format_histogram(lines, name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.total}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    lines = ['# TYPE vox_http_request_duration_seconds histogram']
+    for (route, method), histogram in list(metrics.http.items()):
+        format_histogram(lines, 'vox_http_request_duration_seconds', f'route="{route}",method="{method}"', histogram)
+    lines.append('# TYPE vox_http_requests_total counter')
+    for (route, method, status), count in list(metrics.http_status.items()):
+        lines.append(f'vox_http_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+    lines.append('# TYPE vox_socketio_event_duration_seconds histogram')
+    for event, histogram in list(metrics.events.items()):
+        format_histogram(lines, 'vox_socketio_event_duration_seconds', f'event="{event}"', histogram)
+    lines.append('# TYPE vox_socketio_events_total counter')
+    for event, histogram in list(metrics.events.items()):
+        lines.append(f'vox_socketio_events_total{{event="{event}"}} {histogram.count}')
+    lines.append('# TYPE vox_db_query_duration_seconds histogram')
+    for kind, histogram in list(metrics.queries.items()):
+        format_histogram(lines, 'vox_db_query_duration_seconds', f'kind="{kind}"', histogram)
+    lines.append('# TYPE vox_db_queries_total counter')
+    for kind, histogram in list(metrics.queries.items()):
+        lines.append(f'vox_db_queries_total{{kind="{kind}"}} {histogram.count}')
+    
+    limits = rate_limiter.stats()
+    lines.append('# TYPE vox_rate_limit_allowed_total counter')
+    for name, count in limits['allowed'].items():
+        lines.append(f'vox_rate_limit_allowed_total{{limit="{name}"}} {count}')
+    lines.append('# TYPE vox_rate_limit_rejected_total counter')
+    for name, count in limits['rejected'].items():
+        lines.append(f'vox_rate_limit_rejected_total{{limit="{name}"}} {count}')
+    lines.append('# TYPE vox_fanout_delivery_seconds histogram')
+    format_histogram(lines, 'vox_fanout_delivery_seconds', 'event="new_message"', fanout.latency)
+    lines.append('# TYPE vox_executor_wait_seconds histogram')
+    for executor in executors:
+        format_histogram(lines, 'vox_executor_wait_seconds', f'executor="{executor.name}"', executor.wait)
+    lines.append('# TYPE vox_executor_run_seconds histogram')
+    for executor in executors:
+        format_histogram(lines, 'vox_executor_run_seconds', f'executor="{executor.name}"', executor.run_time)
+    for name, kind, field in (('vox_executor_queued', 'gauge', 'queued'), ('vox_executor_active', 'gauge', 'active'),
+                              ('vox_executor_workers', 'gauge', 'workers')):
+        lines.append(f'# TYPE {name} {kind}')
+        for executor in executors:
+            lines.append(f'{name}{{executor="{executor.name}"}} {getattr(executor, field)}')
+    
+    rooms = socketio.server.manager.rooms.get('/', {})
+    pool = db_pool.stats()
+    cache = session_cache.stats()
+    writer = message_writer.stats()
+    gauges = [
+        ('vox_socketio_connected_sockets', 'gauge', len(socket_sessions)),
+        ('vox_socketio_connected_users', 'gauge', len(user_sids)),
+        # Комната None - служебная "все клиенты", каждая sid - личная комната клиента
+        ('vox_socketio_rooms', 'gauge', sum(1 for room in rooms if room is not None and room not in socket_sessions)),
+        ('vox_db_pool_size', 'gauge', pool['size']),
+        ('vox_db_pool_connections', 'gauge', pool['created']),
+        ('vox_db_pool_in_use', 'gauge', pool['in_use']),
+        ('vox_db_pool_waits_total', 'counter', pool['waits']),
+        ('vox_db_pool_timeouts_total', 'counter', pool['timeouts']),
+        ('vox_db_pool_wait_seconds_total', 'counter', pool['wait_time_total']),
+        ('vox_session_cache_entries', 'gauge', cache['size']),
+        ('vox_session_cache_hits_total', 'counter', cache['hits']),
+        ('vox_session_cache_misses_total', 'counter', cache['misses']),
+        ('vox_message_writer_queued', 'gauge', writer['queued']),
+        ('vox_message_writer_batches_total', 'counter', writer['batches']),
+        ('vox_message_writer_messages_total', 'counter', writer['messages']),
+        ('vox_message_writer_failed_total', 'counter', writer['failed']),
+        ('vox_presence_online_users', 'gauge', presence.stats()['online']),
+        ('vox_sessions_created_total', 'counter', session_manager.created),
+        ('vox_sessions_renewed_total', 'counter', session_manager.renewed),
+        ('vox_sessions_evicted_total', 'counter', session_manager.evicted),
+        ('vox_sessions_reclaimed_total', 'counter', session_manager.reclaimed),
+        ('vox_retention_moved_total', 'counter', retention.moved),
+        ('vox_retention_archive_reads_total', 'counter', retention.archive_reads),
+        ('vox_fanout_lagging_sockets', 'gauge', fanout.stats()['lagging']),
+        ('vox_fanout_skipped_total', 'counter', fanout.skipped),
+        ('vox_fanout_resyncs_total', 'counter', fanout.resyncs),
+        ('vox_fanout_dropped_total', 'counter', fanout.dropped),
+        ('vox_rate_limit_buckets', 'gauge', limits['buckets'])
+    ]
+    for name, kind, value in gauges:
+        lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'{name} {value}')
+    
+    return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+def user_moderated(user_id, banned):
+    session_cache.invalidate_user(user_id)
+    if banned:
+        for sid in list(user_sids.get(user_id, ())):
+            socketio.server.disconnect(sid, namespace='/')
+
+CLUSTER_EVENTS = {
+    'invalidate_token': session_cache.invalidate,
+    'user_moderated': user_moderated,
+    'membership_changed': membership_changed,
+    'fanout': fanout.emit
+}
+
+def handle_cluster_event(action, args):
+    handler = CLUSTER_EVENTS.get(action)
+    if handler is None:
+        app.logger.warning('Неизвестное событие кластера: %s', action)
+        return
+    handler(*args)
+
+# Применяет изменение локально и рассылает его остальным процессам кластера
+def cluster_notify(action, *args):
+    handle_cluster_event(action, args)
+    manager = socketio.server.manager
+    if isinstance(manager, ClusterBusMixin):
+        manager.publish_cluster(action, list(args))
+
+def shutdown():
+    image_pipeline.close()
+    try:
+        presence.flush()
+    except Exception:
+        app.logger.exception('Не удалось сохранить присутствие при остановке')
+    try:
+        session_manager.flush()
+    except Exception:
+        app.logger.exception('Не удалось сохранить продления сессий при остановке')
+
+def run_broker(url):
+    print(f"Брокер сообщений Vox слушает {url}")
+    MessageBroker(url, BROKER_SECRET, BROKER_PEER_QUEUE).serve()
+
+# Мастер-процесс: встроенный брокер + N воркеров на одном порту (SO_REUSEPORT).
+# Для нескольких узлов: на одном запускается --broker, остальные получают VOX_MESSAGE_QUEUE.
+def run_workers(count):
+    url = MESSAGE_QUEUE or DEFAULT_BROKER_URL
+    if url.startswith(('vox://', 'vox+unix://')):
+        eventlet.spawn(run_broker, url)
+    env = dict(os.environ, VOX_MESSAGE_QUEUE=url, VOX_WORKERS='1')
+    children = [subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=dict(env, VOX_WORKER_ID=str(i)))
+                for i in range(count)]
+    try:
+        # Упавший воркер останавливает всю группу - перезапуском занимается платформа
+        while all(child.poll() is None for child in children):
+            eventlet.sleep(1)
+    finally:
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+        for child in children:
+            child.wait()
 
 if __name__ == '__main__':
-    init_db()
-    create_creator_user()
+    parser = argparse.ArgumentParser(description='Сервер Vox')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('VOX_WORKERS', 1)),
+                        help='число процессов-воркеров на этом узле')
+    parser.add_argument('--broker', action='store_true',
+                        help='запустить только встроенный брокер сообщений')
+    args = parser.parse_args()
+    
+    # SIGTERM (остановка на Railway/Render) -> SystemExit, чтобы отработал shutdown()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    if args.broker:
+        run_broker(MESSAGE_QUEUE or DEFAULT_BROKER_URL)
+        sys.exit(0)
+    
+    worker_id = os.environ.get('VOX_WORKER_ID')
+    if worker_id is None:
+        init_db()
+        create_creator_user()
     port = int(os.environ.get('PORT', 5000))
-    print(f"Сервер Vox запущен на порту {port}")
-    socketio.run(app, host='0.0.0.0', port=port, allow_unsafe_werkzeug=True)
+    
+    if args.workers > 1:
+        print(f"Сервер Vox: {args.workers} воркеров на порту {port}")
+        run_workers(args.workers)
+        sys.exit(0)
+    
+    print(f"Сервер Vox запущен на порту {port}" + (f" (воркер {worker_id})" if worker_id else ""))
+    if worker_id in (None, '0'):
+        search_backfill.start()
+        session_manager.start(sweep=True)
+        retention.start()
+    print(f"Пул соединений БД: {DB_POOL_SIZE} (WAL, synchronous={DB_SYNCHRONOUS}, cache {DB_CACHE_SIZE_KB}KB, mmap {DB_MMAP_SIZE} байт)")
+    if MESSAGE_QUEUE:
+        # Слушаем шину сразу, а не с первого сокета: служебные события нужны и без клиентов
+        socketio.server.manager_initialized = True
+        socketio.server.manager.initialize()
+        print(f"Очередь сообщений: {MESSAGE_QUEUE}")
+    try:
+        socketio.run(app, host='0.0.0.0', port=port, allow_unsafe_werkzeug=True)
+    finally:
+        shutdown()